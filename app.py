@@ -4,7 +4,7 @@ Streamlit-app for Asker Fotball sin RAG-demo.
 - Bygger en TF-IDF- eller OpenAI-indeks fra .md-filer i `kb/` første gang (eller ved behov)
 - Lar brukeren stille spørsmål og får et kort, kildebasert svar + topp-k kilder
 
-Denne versjonen håndterer trygt pickled numpy-arrays (allow_pickle=True) og
+Indeksen valideres én gang per prosess (memory-mappet, uten pickle), og appen
 støtter generering av svar via OpenAI dersom ``USE_OPENAI`` og en gyldig API-nøkkel
 er satt. Hvis ikke benyttes en ekstraktiv strategi.
 """
@@ -13,11 +13,13 @@ from __future__ import annotations
 
 import os
 from pathlib import Path
+from types import SimpleNamespace
 import numpy as np
 import streamlit as st
+from scipy import sparse
 
 # Lokale moduler
-from src.answer import answer
+from src.answer import answer, cache_clear
 from src.ingest import build_index, OPENAI_API_KEY
 from src.utils import get_hf_api
 
@@ -55,32 +57,74 @@ def _secret(name: str, default=None):
         return default
 
 
-USE_OPENAI = _env_flag("USE_OPENAI", bool(OPENAI_API_KEY))
-CHAT_MODEL = os.getenv("CHAT_MODEL", _secret("CHAT_MODEL", "tf-idf"))
-DATA_DIR = Path(os.getenv("DATA_DIR", _secret("DATA_DIR", "data")))
-KB_DIR = os.getenv("KB_DIR", _secret("KB_DIR", "kb"))
-DEBUG_UI = _env_flag("DEBUG_UI", False)
-HF_SPACE = os.getenv("HF_SPACE", _secret("HF_SPACE"))
+@st.cache_resource
+def _config() -> SimpleNamespace:
+    """
+    Les konfigurasjon fra env/secrets én gang per prosess. Streamlit kjører
+    hele skriptet på nytt ved hver interaksjon, så oppslagene caches her.
+    """
+    return SimpleNamespace(
+        use_openai=_env_flag("USE_OPENAI", bool(OPENAI_API_KEY)),
+        chat_model=os.getenv("CHAT_MODEL", _secret("CHAT_MODEL", "tf-idf")),
+        data_dir=Path(os.getenv("DATA_DIR", _secret("DATA_DIR", "data"))),
+        kb_dir=os.getenv("KB_DIR", _secret("KB_DIR", "kb")),
+        debug_ui=_env_flag("DEBUG_UI", False),
+        hf_space=os.getenv("HF_SPACE", _secret("HF_SPACE")),
+    )
+
+
+_cfg = _config()
+USE_OPENAI = _cfg.use_openai
+CHAT_MODEL = _cfg.chat_model
+DATA_DIR = _cfg.data_dir
+KB_DIR = _cfg.kb_dir
+DEBUG_UI = _cfg.debug_ui
+HF_SPACE = _cfg.hf_space
 
+_get_hf_api = st.cache_resource(get_hf_api)
 
-hf_space_info = None
-if HF_SPACE:
+
+@st.cache_data(ttl=3600)
+def _space_info(space: str):
+    """Hent Space-info fra Hugging Face Hub (nettverkskall, caches i en time)."""
     try:
-        hf_space_info = get_hf_api().space_info(HF_SPACE)
+        return _get_hf_api().space_info(space)
     except Exception as e:  # pragma: no cover - kun best effort
-        hf_space_info = {"error": str(e)}
+        return {"error": str(e)}
 
 
-def ensure_index() -> None:
+hf_space_info = _space_info(HF_SPACE) if HF_SPACE else None
+
+
+@st.cache_resource
+def _index_ok() -> bool:
     """
-    Bygg indeksen første gang eller når filer mangler eller er korrupt.
-    Denne funksjonen tillater pickled numpy-arrays og forsøker å konvertere dem
-    til en 2D float-array for enkel validering.
+    Sjekk at indeksartefaktene finnes og har forventet form. Resultatet
+    caches per prosess, så sjekken kjøres ikke på nytt ved hver rerun.
+    Tette vektorer åpnes memory-mappet (uten pickle) for kun å lese formen.
     """
     vec = DATA_DIR / "vectors.npy"
+    vec_sparse = DATA_DIR / "vectors.npz"
     meta = DATA_DIR / "meta.jsonl"
-    need_rebuild = False
+    if not meta.exists():
+        return False
+    try:
+        if vec.exists():
+            X = np.load(vec, mmap_mode="r", allow_pickle=False)
+        elif vec_sparse.exists():
+            # TF-IDF lagres som sparse CSR-matrise
+            X = sparse.load_npz(vec_sparse)
+        else:
+            return False
+        return X.ndim == 2 and X.shape[0] > 0
+    except Exception:
+        return False
+
 
+def ensure_index() -> None:
+    """
+    Bygg indeksen første gang eller når filer mangler eller er korrupt.
+    """
     # Hvis noen vil skru på OpenAI senere, gi tidlig beskjed om nøkkel mangler
     if USE_OPENAI and not OPENAI_API_KEY:
         st.error(
@@ -89,26 +133,7 @@ def ensure_index() -> None:
         )
         st.stop()
 
-    if not vec.exists() or not meta.exists():
-        need_rebuild = True
-    else:
-        try:
-            X = np.load(vec, allow_pickle=True)
-            # Hvis objekt-array: forsøk å stable til en matrise av floats
-            if X.dtype == object:
-                try:
-                    X_tmp = np.vstack([np.asarray(v, dtype="float32") for v in X])
-                except Exception:
-                    X_tmp = None
-                    need_rebuild = True
-                X = X_tmp if X_tmp is not None else X
-            # Sjekk at matrisen har forventet form
-            if X is None or getattr(X, "ndim", 0) != 2 or X.shape[0] == 0:
-                need_rebuild = True
-        except Exception:
-            need_rebuild = True
-
-    if need_rebuild:
+    if not _index_ok():
         st.info("Indeks ikke funnet eller korrupt – bygger nå …")
         DATA_DIR.mkdir(parents=True, exist_ok=True)
         try:
@@ -119,6 +144,9 @@ def ensure_index() -> None:
                 "Legg inn kunnskapsfiler i mappen `kb/` (f.eks. `kb/billetter.md`)."
             )
             st.stop()
+        # Valider på nytt ved neste rerun nå som artefaktene er skrevet
+        _index_ok.clear()
+        cache_clear()
 
 
 # ---------- UI ----------
@@ -1,6 +1,7 @@
 """
 Script for å bygge vektorindeksen for Asker Fotball.
 Kjør denne før du starter appen hvis du har endret innholdet i `kb/`.
+Bruk `--force` for å bygge alle OpenAI-embeddings på nytt.
 """
 
 import sys
@@ -15,8 +16,9 @@ from src.ingest import build_index
 
 
 def main() -> None:
-    kb_dir = sys.argv[1] if len(sys.argv) > 1 else "kb"
-    build_index(kb_dir)
+    args = [a for a in sys.argv[1:] if a != "--force"]
+    kb_dir = args[0] if args else "kb"
+    build_index(kb_dir, force="--force" in sys.argv[1:])
 
 
 if __name__ == "__main__":
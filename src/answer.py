@@ -14,29 +14,39 @@ beste treff.
 
 from __future__ import annotations
 
+import asyncio
+import heapq
+import json
+from functools import lru_cache
 import os
 import re
-from typing import Dict, List, Tuple, Set
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple, Set
 
-from src.utils import env_flag
-from src.retrieve import search
+from src.utils import compile_triggers, env_flag, match_groups, orjson
+from src.retrieve import clear_query_cache, search, search_many
 
 USE_OPENAI: bool = env_flag("USE_OPENAI", False)
 CHAT_MODEL: str = os.getenv("CHAT_MODEL", "gpt-4o-mini")
 
-# Initialiser OpenAI-klient dersom aktivert
+# Initialiser OpenAI-klienter dersom aktivert. Klientene holdes på modulnivå,
+# så HTTP-forbindelsene (keep-alive) gjenbrukes mellom kall.
 _openai = None
+_openai_async = None  # AsyncOpenAI, brukes av `answer_async`
 if USE_OPENAI:
     try:
-        from openai import OpenAI  # type: ignore
+        from openai import AsyncOpenAI, OpenAI  # type: ignore
         api_key = os.getenv("OPENAI_API_KEY")
         project = os.getenv("OPENAI_PROJECT")
         if api_key:
             _openai = OpenAI(api_key=api_key, project=project or None)
+            _openai_async = AsyncOpenAI(api_key=api_key, project=project or None)
         else:
             _openai = OpenAI()  # stol på globale config
+            _openai_async = AsyncOpenAI()
     except Exception:
         _openai = None
+        _openai_async = None
 
 # Systemprompt brukt for generativ modus
 SYSTEM_PROMPT = (
@@ -45,103 +55,71 @@ SYSTEM_PROMPT = (
     "Hvis kildene ikke dekker spørsmålet, si 'Jeg vet ikke'."
 )
 
-# Synonymer for utvidet søk i fotballdomenet
-SYN: Dict[str, List[str]] = {
-    "billett": [
-        "billett", "billetter", "sesongkort", "sesong-kort", "sesongabonnement",
-        "foyka+", "foyka plus", "pris", "priser", "kostnad", "inngang", "adgang"
-    ],
-    "kamp": [
-        "kamp", "kamper", "terminliste", "kampdag", "kampdager", "avspark",
-        "match", "program", "kampstart"
-    ],
-    "parkering": [
-        "parkering", "parkere", "p-plass", "p-plasser", "parkeringsplass",
-        "easypark", "bil"
-    ],
-    "stadion": [
-        "stadion", "arena", "føyka", "foyka", "anlegg", "tribune", "stadio",
-        "fotballhuset"
-    ],
-    "medlemskap": [
-        "medlemskap", "medlem", "kontingent", "medlemskontingent",
-        "innmelding", "bli medlem"
-    ],
-    "kontakt": [
-        "kontakt", "telefon", "tlf", "mail", "e-post", "email", "adresse", "epost"
-    ],
-    "åpningstider": [
-        "åpningstider", "åpner", "åpent", "stengt", "åpningstid"
-    ],
-    "sponsor": [
-        "sponsor", "sponsorer", "partner", "partnere", "marked", "bedriftsnettverk"
-    ],
-    "samfunn": [
-        "samfunn", "gatelag", "asker united", "community", "sammen for fotball",
-        "aktiviteter"
-    ],
-    "historie": [
-        "historie", "historisk", "grunnlagt", "stiftet", "rekord", "legender",
-        "fakta"
-    ],
-    "lag": [
-        "lag", "spillere", "spillertropp", "trener", "keeper", "forsvar",
-        "midtbane", "angrep", "a-lag"
-    ],
-    "marked": [
-        "marked", "partner", "sponsor", "sponsorer", "nettverk", "synlighet"
-    ],
-    "aktivitet": [
-        "aktivitet", "akademi", "camp", "kurs", "leir", "trening", "lek"
-    ],
-}
+# Synonymer og dokumenttype-hint lastes fra én kilde (`synonyms.json`)
+_SYNONYMS_PATH = Path(__file__).with_name("synonyms.json")
+
 
+def _load_synonyms(path: Path = _SYNONYMS_PATH) -> Tuple[Dict[str, Tuple[str, ...]], Dict[str, str]]:
+    """
+    Les synonymlistene og doc hints. `doc_hints` i filen peker på en nøkkel i
+    `synonyms`, så hver triggerliste finnes kun ett sted.
+
+    Returnerer (synonymer, {doc_type: synonymnøkkel}).
+    """
+    raw = path.read_bytes()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    syn = {key: tuple(words) for key, words in data["synonyms"].items()}
+    return syn, dict(data["doc_hints"])
+
+
+# Synonymer for utvidet søk i fotballdomenet
+SYN, _HINT_KEYS = _load_synonyms()
 # Kart over dokumenttyper til triggere for foretrukne kategorier
-DOC_HINTS: Dict[str, List[str]] = {
-    "billett": SYN["billett"],
-    "terminliste": SYN["kamp"],
-    "kontakt": SYN["kontakt"],
-    "samfunn": SYN["samfunn"],
-    "historie": SYN["historie"],
-    "stadion": SYN["stadion"],
-    "lag": SYN["lag"],
-    "marked": SYN["marked"],
-    "aktivitet": SYN["aktivitet"],
-}
+DOC_HINTS: Dict[str, Tuple[str, ...]] = {dt: SYN[key] for dt, key in _HINT_KEYS.items()}
+
 
+_SYN_MATCHER, _SYN_LABELS = compile_triggers(SYN)
+# Klubbnavn som fjernes fra spørringen før trigger-matching
+_CLUB_RE = re.compile(r"\basker fotball\b|\basker fk\b|\bføyka\b")
 
-def _expand_query(q: str) -> Tuple[str, Set[str], List[str]]:
+
+@lru_cache(maxsize=512)
+def _expand_query(q: str) -> Tuple[str, FrozenSet[str], Tuple[str, ...]]:
     """
     Fjern støy (klubbnavn), identifiser foretrukne dokumenttyper basert på triggere,
     og bygg en utvidet spørring med synonymer.
 
-    Returnerer (expanded_query, preferred_doc_types, extra_terms).
+    Returnerer (expanded_query, preferred_doc_types, extra_terms). Resultatet
+    memoiseres per spørring, og er derfor uforanderlig (frozenset/tuple).
     """
-    ql = q.lower()
     # Fjern klubbnavn for å unngå bias
-    ql = re.sub(r"\basker fotball\b|\basker fk\b|\bføyka\b", " ", ql)
-    ql = ql.strip()
+    ql = _CLUB_RE.sub(" ", q.lower()).strip()
+
+    syn_keys = match_groups(ql, _SYN_MATCHER, _SYN_LABELS)
+    if not syn_keys:
+        # Vanligste tilfelle: ingen triggere, ingenting å utvide
+        return q, frozenset(), ()
 
-    extra: List[str] = []
-    preferred: Set[str] = set()
+    # Doc hints gjenbruker synonymlistene, så de følger direkte av syn_keys
+    preferred = frozenset(dt for dt, key in _HINT_KEYS.items() if key in syn_keys)
+    # Utvidede søkeord fra synonymlistene, dedupliseres og sorteres én gang
+    extra: Set[str] = set()
+    for key in syn_keys:
+        extra.update(SYN[key])
+    terms = tuple(sorted(extra))
+    return f"{q} {' '.join(terms)}", preferred, terms
 
-    # Legg til doc hints basert på triggere
-    for dt, triggers in DOC_HINTS.items():
-        if any(t in ql for t in triggers):
-            preferred.add(dt)
-    # Legg til utvidede søkeord basert på synonymlistene
-    for key, words in SYN.items():
-        if any(t in ql for t in words):
-            extra += words
-    expanded = q if not extra else q + " " + " ".join(sorted(set(extra)))
-    return expanded, preferred, sorted(set(extra))
+
+# Første setningsslutt: tegn etterfulgt av whitespace eller slutten av teksten
+_SENTENCE_END_RE = re.compile(r".+?[.!?](?=\s|$)", re.S)
 
 
 def _first_sentence(txt: str) -> str:
     """Returner første komplette setning (slutter med punktum, utrop eller spørsmålstegn)"""
-    txt = re.sub(r"\s+", " ", (txt or "").strip())
-    m = re.search(r"(.+?[.!?])\s", txt + " ")
-    return (m.group(1) if m else txt)[:280]
+    txt = (txt or "").strip()
+    # Finn setningen i råteksten og komprimer kun den, ikke hele biten
+    m = _SENTENCE_END_RE.match(txt)
+    return " ".join((m.group(0) if m else txt).split())[:280]
 
 
 def _extractive(hits: List[Dict]) -> str:
@@ -153,40 +131,39 @@ def _extractive(hits: List[Dict]) -> str:
     return _first_sentence(hits[0].get("text", "")) or "Jeg vet ikke"
 
 
-def _score(h: Dict, keys: List[str], preferred: Set[str]) -> float:
+def _score(h: Dict, keys: Iterable[str], preferred: FrozenSet[str], text_lower: Optional[str] = None) -> float:
     """
     Beregn en heuristisk score for et dokument basert på:
     - Basisscore fra søket (cosinus-similaritet)
     - Bonus hvis dokumenttypen er i preferred
     - Bonus hvis søkeordene forekommer i teksten
+
+    `text_lower` kan sendes inn når teksten allerede er gjort om til små bokstaver.
     """
     base = float(h.get("score", 0.0))
     bonus = 0.15 if h.get("doc_type") in preferred else 0.0
-    txt = (h.get("text") or "").lower()
-    bonus += min(0.10, 0.02 * sum(1 for t in keys if t in txt))
+    txt = text_lower if text_lower is not None else (h.get("text") or "").lower()
+    # Delstrengsøk (ikke tokens): søkeord kan være flerords, f.eks. "foyka plus"
+    bonus += min(0.10, 0.02 * sum(map(txt.__contains__, keys)))
     return base + bonus
 
 
-def _rerank(hits: List[Dict], preferred: Set[str], keys: List[str], k: int, min_score: float = 0.15) -> List[Dict]:
+def _rerank(hits: List[Dict], preferred: FrozenSet[str], keys: Tuple[str, ...], k: int, min_score: float = 0.15) -> List[Dict]:
     """
     Rerank treff basert på `_score` og filtrer bort lave scores.
     """
-    scored = [(h, _score(h, keys, preferred)) for h in hits]
-    scored.sort(key=lambda x: x[1], reverse=True)
-    good = [h for h, s in scored if s >= min_score]
-    return good[:k] if good else []
+    scored = []
+    for h in hits:
+        # Små bokstaver én gang per treff
+        s = _score(h, keys, preferred, (h.get("text") or "").lower())
+        if s >= min_score:
+            scored.append((h, s))
+    # Delvis sortering: kun de k beste trengs
+    return [h for h, _ in heapq.nlargest(k, scored, key=lambda x: x[1])]
 
 
-def _llm(q: str, hits: List[Dict]) -> str:
-    """
-    Generer et svar med OpenAI Chat API dersom `_openai` er tilgjengelig.
-    Bruker de fem beste dokumentbitene som kontekst sammen med tidligere meldinger.
-    """
-    if _openai is None:
-        return _extractive(hits)
-    # Bygg kontekst av topp 5 utdrag
-    ctx = "\n\n".join(f"Utdrag {i+1}:\n{h.get('text','')}" for i, h in enumerate(hits[:5]))
-    # Hent historikk fra Streamlit session_state hvis tilgjengelig
+def _history_messages() -> List[Dict]:
+    """Systemprompt og de siste tre turene fra Streamlit session_state (hvis tilgjengelig)."""
     history_msgs = []
     try:
         import streamlit as st  # type: ignore
@@ -199,16 +176,50 @@ def _llm(q: str, hits: List[Dict]) -> str:
                 history_msgs.append({"role": "assistant", "content": ua})
     except Exception:
         history_msgs = []
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    messages += history_msgs
+    return [{"role": "system", "content": SYSTEM_PROMPT}] + history_msgs
+
+
+def _chat_messages(q: str, hits: List[Dict], prefix: Optional[List[Dict]] = None) -> List[Dict]:
+    """Bygg meldingene til Chat API: `prefix` (system + historikk) og spørsmål med kontekst."""
+    # Bygg kontekst av topp 5 utdrag
+    ctx = "\n\n".join(f"Utdrag {i+1}:\n{h.get('text','')}" for i, h in enumerate(hits[:5]))
+    messages = list(prefix) if prefix is not None else _history_messages()
     messages.append({
         "role": "user",
         "content": f"Spørsmål: {q}\n\nKontekst:\n{ctx}\n\nInstruks: Svar med egne ord i 1–3 setninger."
     })
+    return messages
+
+
+def _llm(q: str, hits: List[Dict], prefix: Optional[List[Dict]] = None) -> str:
+    """
+    Generer et svar med OpenAI Chat API dersom `_openai` er tilgjengelig.
+    Bruker de fem beste dokumentbitene som kontekst sammen med tidligere meldinger
+    (eller `prefix`, se `_chat_messages`).
+    """
+    if _openai is None:
+        return _extractive(hits)
     try:
         r = _openai.chat.completions.create(
             model=CHAT_MODEL,
-            messages=messages,
+            messages=_chat_messages(q, hits, prefix),
+            temperature=0.2,
+            max_tokens=150
+        )
+        return (r.choices[0].message.content or "").strip()
+    except Exception:
+        return _extractive(hits)
+
+
+async def _llm_async(q: str, hits: List[Dict], prefix: Optional[List[Dict]] = None) -> str:
+    """Som `_llm`, men med `AsyncOpenAI` slik at event-loopen ikke blokkeres."""
+    if _openai_async is None:
+        # Synkron klient i en tråd, med samme systemprompt og historikk
+        return await asyncio.to_thread(_llm, q, hits, prefix)
+    try:
+        r = await _openai_async.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=_chat_messages(q, hits, prefix),
             temperature=0.2,
             max_tokens=150
         )
@@ -217,18 +228,75 @@ def _llm(q: str, hits: List[Dict]) -> str:
         return _extractive(hits)
 
 
+def cache_clear() -> None:
+    """Tøm memoiserte spørringsutvidelser og spørringsvektorer, f.eks. etter ny indeks."""
+    _expand_query.cache_clear()
+    clear_query_cache()
+
+
+def _select(raw_hits: List[Dict], preferred: FrozenSet[str], keys: Tuple[str, ...], k: int) -> Tuple[List[Dict], List[Dict]]:
+    """Rerank rå treff. Returnerer (treff, reserve) der reserve er de k første rå treffene."""
+    return _rerank(raw_hits, preferred, keys, k), raw_hits[:k]
+
+
+def _respond(q: str, hits: List[Dict], fallback: List[Dict]) -> Tuple[str, List[Dict]]:
+    """Lag svaret for én spørring fra rerankede treff."""
+    if not hits:
+        # Ingen gode treff – returner rå treff for transparens
+        return "Jeg vet ikke", fallback
+    out = _llm(q, hits) if USE_OPENAI and _openai is not None else _extractive(hits)
+    return _final_text(out), hits
+
+
+def _final_text(out: str) -> str:
+    """Svar på under to ord regnes som tomt."""
+    if not out or len(out.split()) < 2:
+        return "Jeg vet ikke"
+    return out
+
+
+def _search_hits(q: str, k: int) -> Tuple[List[Dict], List[Dict]]:
+    """Utvid, søk og rerank én spørring. Returnerer (treff, reserve)."""
+    qx, preferred, keys = _expand_query(q)
+    return _select(search(qx, max(k * 2, 6)), preferred, keys, k)
+
+
 def answer(q: str, k: int = 6) -> Tuple[str, List[Dict]]:
     """
     Hovedfunksjon brukt av Streamlit-appen.
     Returnerer et kort svar og en liste med treff (kilder).
     """
-    qx, preferred, keys = _expand_query(q)
-    raw_hits = search(qx, max(k * 2, 6))
-    hits = _rerank(raw_hits, preferred, keys, k)
+    hits, fallback = _search_hits(q, k)
+    return _respond(q, hits, fallback)
+
+
+def answer_batch(queries: List[str], k: int = 6) -> List[Tuple[str, List[Dict]]]:
+    """
+    Som `answer`, men for mange spørringer samtidig (evaluering/avspilling).
+    Søket gjøres samlet via `search_many`; returnerer (svar, treff) per spørring.
+    """
+    expanded = [_expand_query(q) for q in queries]
+    raw = search_many([qx for qx, _, _ in expanded], max(k * 2, 6))
+    return [
+        _respond(q, *_select(raw_hits, preferred, keys, k))
+        for q, (_, preferred, keys), raw_hits in zip(queries, expanded, raw)
+    ]
+
+
+async def answer_async(q: str, k: int = 6) -> Tuple[str, List[Dict]]:
+    """
+    Asynkron variant av `answer` for async-kallere (f.eks. et API eller
+    `asyncio.gather` over mange spørsmål). Søket kjøres i en tråd mens
+    systemprompt og historikk bygges, og LLM-kallet går via `AsyncOpenAI`.
+    """
+    search_task = asyncio.create_task(asyncio.to_thread(_search_hits, q, k))
+    prefix = _history_messages() if USE_OPENAI and _openai is not None else None
+    hits, fallback = await search_task
     if not hits:
         # Ingen gode treff – returner rå treff for transparens
-        return "Jeg vet ikke", raw_hits[:k]
-    out = _llm(q, hits) if USE_OPENAI and _openai is not None else _extractive(hits)
-    if not out or len(out.split()) < 2:
-        out = "Jeg vet ikke"
-    return out, hits
+        return "Jeg vet ikke", fallback
+    if USE_OPENAI and _openai is not None:
+        out = await _llm_async(q, hits, prefix)
+    else:
+        out = _extractive(hits)
+    return _final_text(out), hits
@@ -2,22 +2,24 @@
 FAISS‑indeksbygger for Asker Fotball.
 
 Denne modulen sørger for å laste vektorer og metadata fra disk og å bygge
-en FAISS‑indeks dersom den mangler. Basert på RAG‑Asker‑Tennis.
+en FAISS‑indeks dersom den mangler. Gjelder kun tette OpenAI-embeddings;
+TF‑IDF lagres sparse og trenger ingen FAISS. Basert på RAG‑Asker‑Tennis.
 """
 
 from __future__ import annotations
 
-import json
 from pathlib import Path
 
 import faiss  # type: ignore
 import numpy as np
 
 from src.ingest import build_index
+from src.utils import read_jsonl
 
 # Artefaktstier
 INDEX_PATH = Path("data/index.faiss")
 VEC_PATH = Path("data/vectors.npy")
+SPARSE_VEC_PATH = Path("data/vectors.npz")
 META_PATH = Path("data/meta.jsonl")
 
 
@@ -25,6 +27,9 @@ def _ensure_artifacts() -> None:
     """
     Sørger for at vectors/meta/index finnes. Hvis ikke, bygges de fra kb/.
     """
+    if SPARSE_VEC_PATH.exists() and META_PATH.exists():
+        # TF-IDF-indeks (sparse) – ingen tett vektorfil eller FAISS-fil hører til
+        return
     missing = [p for p in [VEC_PATH, META_PATH, INDEX_PATH] if not p.exists()]
     if missing:
         print(
@@ -36,40 +41,37 @@ def _ensure_artifacts() -> None:
 
 def _load_vectors_raw() -> np.ndarray:
     """
-    Last inn vektorfilen fra disk med allow_pickle=True.
+    Last inn vektorfilen fra disk uten pickle (memory-mappet, read-only).
 
-    returnerer en numpy array (eventuelt dtype=object) som ikke er normalisert.
+    Returnerer en tett numpy array som ikke nødvendigvis er normalisert.
+    Kun tette embeddings (OpenAI) støttes: en sparse TF-IDF-indeks
+    (`vectors.npz`) søkes direkte med sparse matriseprodukt i `src/retrieve.py`
+    og gjøres ikke tett for FAISS.
     """
+    if not VEC_PATH.exists() and SPARSE_VEC_PATH.exists():
+        raise RuntimeError(
+            f"'{SPARSE_VEC_PATH}' er en sparse TF-IDF-indeks; FAISS brukes kun for "
+            "OpenAI-embeddings (bygg med USE_OPENAI=1)."
+        )
     try:
-        X = np.load(VEC_PATH, allow_pickle=True)
+        return np.load(VEC_PATH, mmap_mode="r", allow_pickle=False)
+    except ValueError as e:
+        # Eldre vektorfiler lagret som objekt-array (pickle) støttes ikke lenger
+        raise RuntimeError(
+            f"Vektorfil '{VEC_PATH}' har et eldre format ({e}). "
+            "Kjør build_index på nytt for å generere en korrekt vektorfil."
+        )
     except Exception as e:
         raise RuntimeError(f"Kunne ikke laste vektorfil '{VEC_PATH}': {e}")
-    return X
 
 
 def load_vectors() -> np.ndarray:
     """
-    Last inn vektorer, sørg for riktig datatype og L2-normaliser dem.
-    Tillater pickled objekt arrays og konverterer dem til float32 hvis mulig.
+    Last inn vektorer som float32 og L2-normaliser dem.
     """
     _ensure_artifacts()
-    X = _load_vectors_raw()
-    # Hvis objekt array (kan komme fra eldre numpy versjoner eller varierende dimensjoner)
-    if X.dtype == object:
-        try:
-            # Vektorer er antatt å være 1D-arrays eller lister av float
-            X = np.vstack([np.asarray(v, dtype="float32") for v in X])
-        except Exception as e:
-            raise RuntimeError(
-                f"Vektorfil '{VEC_PATH}' inneholder uventet format: {e}. "
-                "Kjør ingest.py på nytt for å generere en korrekt vektorfil."
-            )
-    else:
-        # Sørg for riktig dtype
-        try:
-            X = X.astype("float32")
-        except Exception:
-            pass
+    # Alltid en egen, skrivbar kopi: normalize_L2 endrer matrisen på plass
+    X = np.array(_load_vectors_raw(), dtype="float32")
     # Normaliser i stedet for å anta at det allerede er normalisert
     if X.size > 0:
         faiss.normalize_L2(X)
@@ -93,8 +95,7 @@ def load_meta():
     Last inn metadatafilen fra disk og returner en liste av dicts.
     """
     _ensure_artifacts()
-    with META_PATH.open(encoding="utf-8") as f:
-        return [json.loads(l) for l in f]
+    return read_jsonl(META_PATH)
 
 
 if __name__ == "__main__":
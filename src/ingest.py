@@ -3,8 +3,8 @@ Bygger vektorindeks for Asker Fotball.
 
 Denne modulen leser alle markdown-filer i `kb/` og eventuelle
 jsonl-filer i `data/processed/`, deler dem i biter og skriver en
-vektorfil (`vectors.npy`) og en metadatafil (`meta.jsonl`) til
-`DATA_DIR` (default `data/`).
+vektorfil (`vectors.npy` for OpenAI, sparse `vectors.npz` for TF‑IDF)
+og en metadatafil (`meta.jsonl`) til `DATA_DIR` (default `data/`).
 
 Indeksen kan genereres med enten OpenAI‑embeddings eller en
 lokal TF‑IDF representasjon. Valget styres av miljøvariabelen
@@ -17,15 +17,23 @@ Basert på RAG‑Asker‑Tennis, men tilpasset Asker Fotball.
 
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import re
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from itertools import islice
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Tuple, Optional
 
 import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 
-from src.utils import env_flag
+from src.utils import _read_text_file, env_flag, index_signature, read_jsonl
 
 try:
     import streamlit as st  # type: ignore
@@ -37,6 +45,16 @@ try:
 except Exception:
     faiss = None  # type: ignore
 
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # type: ignore
+
+try:
+    import tiktoken  # type: ignore
+except Exception:
+    tiktoken = None  # type: ignore
+
 # Forsøk å importere python-dotenv. Dersom biblioteket ikke er installert,
 # defineres en dummy funksjon slik at koden fortsatt fungerer.
 try:
@@ -69,20 +87,18 @@ def _get_secret(name: str) -> Optional[str]:
         val = os.getenv(key)
         if isinstance(val, str) and val.strip():
             return val.strip()
-    # 2) Streamlit Secrets
-    try:
-        import streamlit as _st  # lokal import for å unngå sideeffekter
-        for key in variants:
-            try:
-                sval = _st.secrets[key]
-            except Exception:
-                continue
-            if isinstance(sval, str) and sval.strip():
-                return sval.strip()
-            return sval
-        return None
-    except Exception:
+    # 2) Streamlit Secrets (modulens valgfrie `st`-import)
+    if st is None:
         return None
+    for key in variants:
+        try:
+            sval = st.secrets[key]
+        except Exception:
+            continue
+        if isinstance(sval, str) and sval.strip():
+            return sval.strip()
+        return sval
+    return None
 
 
 # ---------- Konfig ----------
@@ -94,6 +110,17 @@ DATA_DIR: Path = Path(_get_secret("DATA_DIR") or "data")
 # Som standard leses dokumenter fra 'kb'
 KB_DIR_DEFAULT: Path = Path(_get_secret("KB_DIR") or "kb")
 
+# Øvre grense for estimerte tokens per embeddings-kall (OpenAI tillater 300k)
+MAX_BATCH_TOKENS: int = 250_000
+# Fra dette antall biter bygges en HNSW-indeks i stedet for flat FAISS-indeks
+FAISS_HNSW_MIN_ROWS: int = 5000
+# Kvantisering i index.faiss: "fp16" (halv båndbredde) eller "int8" (kvart båndbredde)
+EMB_QUANT: str = (_get_secret("EMB_QUANT") or "fp16").strip().lower()
+# Antall tråder for parallell filinnlesing (I/O-bundet, så flere enn CPU-kjerner)
+INGEST_WORKERS: int = int(_get_secret("INGEST_WORKERS") or min(32, (os.cpu_count() or 1) * 4))
+# Maks antall tegn som indekseres fra én markdown-fil (begrenser minnebruk i verste fall)
+MAX_MD_CHARS: int = int(_get_secret("MAX_MD_CHARS") or 256_000)
+
 # ---------- OpenAI-klient ----------
 # Initialiser klient kun dersom USE_OPENAI er aktivt. Vi holder klienten
 # på modulnivå for å kunne gjenbruke forbindelse ved batch‑embedding.
@@ -119,51 +146,97 @@ if USE_OPENAI:
 
 # ---------- Hjelpefunksjoner ----------
 
-def _read_text_file(p: Path) -> str:
-    """Les tekstfil (UTF‑8 eller latin‑1 fallback)."""
-    try:
-        return p.read_text(encoding="utf-8", errors="ignore")
-    except Exception:
-        try:
-            return p.read_text(encoding="latin-1", errors="ignore")
-        except Exception:
-            return ""
+# Regex kompileres én gang ved import i stedet for per fil
+_CODEFENCE_RE = re.compile(r"```.*?```", re.S)
+
+
+def _read_kb_file(p: Path) -> str:
+    """
+    Les en kildefil; av markdown leses høyst `MAX_MD_CHARS` + 1 tegn, slik at
+    en fil som er lengre enn grensen kan oppdages (JSONL leses helt).
+    """
+    return _read_text_file(p, MAX_MD_CHARS + 1 if p.suffix.lower() == ".md" else None)
 
 
 def _strip(txt: str) -> str:
     """Fjern codefences og komprimer whitespace i tekst."""
-    # Fjern kodeblokker mellom ``` … ```
-    txt = re.sub(r"```.*?```", " ", txt, flags=re.S)
-    # Komprimer whitespace
-    txt = re.sub(r"\s+", " ", txt)
-    return txt.strip()
+    # Fjern kodeblokker mellom ``` … ``` (sjelden i kb/, så hopp over regex ellers)
+    if "```" in txt:
+        txt = _CODEFENCE_RE.sub(" ", txt)
+    # NFKC gjør kompatibilitetstegn (f.eks. smale/ikke-brytende mellomrom) ensartede,
+    # og str.split uten argument komprimerer all Unicode-whitespace i en rask C-løkke
+    return " ".join(unicodedata.normalize("NFKC", txt).split())
 
 
-def _iter_docs(kb_root: Path) -> List[Dict]:
+def _slice_offsets(n: int, size: int, overlap: int) -> np.ndarray:
+    """
+    Beregn (start, slutt) for alle vinduer på `size` tegn med `overlap` tegns
+    overlapp over en tekst med lengde `n`. Returnerer en (k, 2) int64-matrise.
+    """
+    starts = np.arange(0, n, size - overlap, dtype=np.int64)
+    return np.stack([starts, np.minimum(starts + size, n)], axis=1)
+
+
+def _chunk_hash(text: str) -> str:
+    """Kort innholdshash for en tekstbit (brukes til å gjenbruke embeddings)."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _iter_docs(kb_root: Path) -> Iterator[Dict]:
     """
     Iterer gjennom alle markdown (.md) filer i `kb_root` og eventuelle
-    jsonl-filer i `data/processed` og returner en liste med dicts.
+    jsonl-filer i `data/processed` og gi (yield) én dict per tekstbit.
+    Bitene produseres lazy, så hele korpuset trenger ikke ligge i minnet.
 
     Hvert element har nøklene: text, source, title, doc_type, version_date,
-    page, chunk_idx og id. Doc_type settes til None her – det beregnes
-    av retrieve-modulen.
+    page, chunk_idx, id og hash (innholdshash brukt ved inkrementell
+    bygging). Doc_type settes til None her – det beregnes av retrieve-modulen.
     """
-    out: List[Dict] = []
-    # Markdown-filer
-    for p in sorted(list(kb_root.rglob("*.md")) + list(Path("data/processed").rglob("*.jsonl"))):
-        if not p.is_file():
-            continue
+    paths = [
+        p for p in sorted(list(kb_root.rglob("*.md")) + list(Path("data/processed").rglob("*.jsonl")))
+        if p.is_file()
+    ]
+    if not paths:
+        return
+    # Filene leses parallelt (I/O frigjør GIL), i rekkefølge og med høyst
+    # `workers` lesinger underveis, så innleste filer ikke hoper seg opp i
+    # minnet foran chunkingen
+    workers = max(1, min(INGEST_WORKERS, len(paths)))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        yield from _docs_from_files(paths, _read_window(ex, paths, workers))
+
+
+def _read_window(ex: ThreadPoolExecutor, paths: List[Path], window: int) -> Iterator[str]:
+    """Les `paths` med `ex` i rekkefølge, med høyst `window` filer sendt inn om gangen."""
+    pending: Deque[Future] = deque()
+    it = iter(paths)
+    for p in islice(it, window):
+        pending.append(ex.submit(_read_kb_file, p))
+    while pending:
+        raw = pending.popleft().result()
+        for p in islice(it, 1):
+            pending.append(ex.submit(_read_kb_file, p))
+        yield raw
+
+
+def _docs_from_files(paths: List[Path], raws: Iterable[str]) -> Iterator[Dict]:
+    """Del innleste filer i biter og gi én dict per bit (se `_iter_docs`)."""
+    for p, raw in zip(paths, raws):
+        # Markdown-filer
         if p.suffix.lower() == ".md":
-            raw = _read_text_file(p)
+            if len(raw) > MAX_MD_CHARS:
+                print(f"[ingest] {p} er større enn {MAX_MD_CHARS} tegn – kun starten indekseres.")
+                raw = raw[:MAX_MD_CHARS]
             clean = _strip(raw)
             if not clean:
                 continue
             # Del teksten i biter på ca 700 tegn med overlapp 120 tegn
             chunk_size = 700
             overlap = 120
-            chunks = [clean[i:i + chunk_size] for i in range(0, len(clean), chunk_size - overlap)]
-            for ci, ch in enumerate(chunks):
-                out.append({
+            offsets = _slice_offsets(len(clean), chunk_size, overlap)
+            for ci, (start, end) in enumerate(offsets.tolist()):
+                ch = clean[start:end]
+                yield {
                     "text": ch,
                     "source": str(p).replace("\\", "/"),
                     "title": p.stem.replace("-", " "),
@@ -172,16 +245,17 @@ def _iter_docs(kb_root: Path) -> List[Dict]:
                     "page": None,
                     "chunk_idx": ci,
                     "id": f"{p.as_posix()}#{ci}",
-                })
+                    "hash": _chunk_hash(ch),
+                }
         else:
             # JSONL-filer med forhåndsprosesserte dokumenter
             ci = 0
-            for line in _read_text_file(p).splitlines():
+            for line in raw.splitlines():
                 line = line.strip()
                 if not line:
                     continue
                 try:
-                    obj = json.loads(line)
+                    obj = orjson.loads(line) if orjson is not None else json.loads(line)
                 except Exception:
                     continue
                 txt = _strip(obj.get("text", ""))
@@ -189,7 +263,7 @@ def _iter_docs(kb_root: Path) -> List[Dict]:
                     continue
                 meta = obj.get("metadata", {})
                 src = meta.get("source") or str(p)
-                out.append({
+                yield {
                     "text": txt,
                     "source": str(src).replace("\\", "/"),
                     "title": meta.get("title"),
@@ -198,21 +272,102 @@ def _iter_docs(kb_root: Path) -> List[Dict]:
                     "page": meta.get("page"),
                     "chunk_idx": ci,
                     "id": f"{Path(src).as_posix()}#{ci}",
-                })
+                    "hash": _chunk_hash(txt),
+                }
                 ci += 1
-    return out
 
 
-def _save_meta(meta: List[Dict]) -> None:
-    """Skriv metadata til `DATA_DIR/meta.jsonl`."""
+def _save_meta(meta: List[Dict], path: Optional[Path] = None) -> None:
+    """Skriv metadata til `path` (standard `DATA_DIR/meta.jsonl`, med orjson hvis tilgjengelig)."""
     DATA_DIR.mkdir(parents=True, exist_ok=True)
-    with (DATA_DIR / "meta.jsonl").open("w", encoding="utf-8") as f:
+    path = path or DATA_DIR / "meta.jsonl"
+    if orjson is not None:
+        # orjson gir UTF-8-bytes uten ASCII-escaping, tilsvarende ensure_ascii=False
+        with path.open("wb") as fb:
+            fb.writelines(orjson.dumps(m) + b"\n" for m in meta)
+        return
+    with path.open("w", encoding="utf-8") as f:
         for m in meta:
             f.write(json.dumps(m, ensure_ascii=False) + "\n")
 
 
-def _build_openai_embeddings(chunks: List[Dict], batch_size: int = 64) -> np.ndarray:
-    """Bygg normaliserte OpenAI-embeddings med batching og feilkontroll."""
+def _retry_after(err: Exception) -> Optional[float]:
+    """Les `Retry-After` (sekunder) fra en OpenAI-feil, hvis headeren finnes."""
+    response = getattr(err, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        val = headers.get("retry-after") or headers.get("Retry-After")
+        return float(val) if val is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _embed_batch(batch: List[str], max_retries: int = 5) -> List[List[float]]:
+    """
+    Hent embeddings for én batch. Ved 429 (rate limit) ventes det så lenge
+    `Retry-After` tilsier (ellers eksponentiell backoff) før nytt forsøk.
+    """
+    delay = 1.0
+    for attempt in range(max_retries + 1):
+        try:
+            r = client.embeddings.create(model=EMBED_MODEL, input=batch)  # type: ignore
+            return [item.embedding for item in r.data]
+        except Exception as e:
+            if getattr(e, "status_code", None) != 429 or attempt == max_retries:
+                raise
+            time.sleep(_retry_after(e) or delay)
+            delay = min(delay * 2, 30.0)
+    return []
+
+
+def _token_counter() -> Callable[[str], int]:
+    """Returner en tokenteller for EMBED_MODEL (tiktoken, ellers ~4 tegn/token)."""
+    if tiktoken is not None:
+        try:
+            enc = tiktoken.encoding_for_model(EMBED_MODEL)
+            return lambda t: len(enc.encode(t))
+        except Exception:
+            pass
+    return lambda t: len(t) // 4 + 1
+
+
+def _pack_batches(
+    texts: Iterable[str], max_inputs: int, max_tokens: int = MAX_BATCH_TOKENS
+) -> Iterator[List[str]]:
+    """
+    Pakk tekster grådig i batcher med høyst `max_inputs` tekster og
+    `max_tokens` estimerte tokens, slik at hvert API-kall utnyttes fullt ut.
+    """
+    count = _token_counter()
+    batch: List[str] = []
+    tokens = 0
+    for t in texts:
+        n = count(t)
+        if batch and (tokens + n > max_tokens or len(batch) >= max_inputs):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(t)
+        tokens += n
+    if batch:
+        yield batch
+
+
+def _build_openai_embeddings(
+    chunks: List[Dict],
+    batch_size: int = 1024,
+    max_in_flight: int = 5,
+    out_path: Optional[Path] = None,
+) -> np.ndarray:
+    """
+    Bygg normaliserte OpenAI-embeddings med batching og feilkontroll.
+
+    Tekstene pakkes i batcher på inntil `batch_size` tekster og
+    `MAX_BATCH_TOKENS` tokens. Inntil `max_in_flight` batcher sendes samtidig
+    slik at nettverksventetiden overlapper. Like tekster embeddes kun én gang.
+    Hver batch skrives til sin plass i
+    resultatmatrisen så snart svaret kommer; med `out_path` er matrisen en
+    memory-mappet `.npy`-fil, slik at skriving til disk overlapper API-kallene.
+    """
     if not OPENAI_API_KEY:
         msg = (
             "OPENAI_API_KEY mangler eller er ugyldig. "
@@ -223,101 +378,310 @@ def _build_openai_embeddings(chunks: List[Dict], batch_size: int = 64) -> np.nda
         raise RuntimeError(msg)
     if client is None:
         raise RuntimeError("OpenAI-klienten er ikke initialisert.")
-    texts = [d["text"] for d in chunks]
-    vecs: List[np.ndarray] = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i + batch_size]
-        try:
-            r = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        except Exception as e:
-            msg = f"Uventet feil ved henting av embeddings: {e}"
-            if st is not None:
-                st.error(msg)
-            raise RuntimeError(msg)
-        for item in r.data:
-            v = np.asarray(item.embedding, dtype="float32")
-            v = v / (np.linalg.norm(v) + 1e-12)
-            vecs.append(v)
-    if not vecs:
+    # Identiske tekster (gjentatt boilerplate) embeddes kun én gang og
+    # spres deretter til alle radene der de forekommer
+    positions: Dict[str, List[int]] = {}
+    for i, d in enumerate(chunks):
+        positions.setdefault(d["text"], []).append(i)
+    unique = list(positions)
+    total = sum(len(v) for v in positions.values())
+    batches = list(_pack_batches(unique, batch_size))
+    offsets = np.cumsum([0] + [len(b) for b in batches]).tolist()
+    if total == 0:
         # Returner tom 0x0 array hvis ingen data
         return np.zeros((0, 1536), dtype="float32")
-    return np.vstack(vecs)
+    out: Optional[np.ndarray] = None
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as ex:
+        futures = {ex.submit(_embed_batch, b): bi for bi, b in enumerate(batches)}
+        try:
+            for fut in as_completed(futures):
+                try:
+                    embeddings = fut.result()
+                except Exception as e:
+                    msg = f"Uventet feil ved henting av embeddings: {e}"
+                    if st is not None:
+                        st.error(msg)
+                    raise RuntimeError(msg)
+                if out is None:
+                    # Dimensjonen er kjent etter første svar; alloker hele matrisen én gang
+                    shape = (total, len(embeddings[0]))
+                    if out_path is not None:
+                        out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=shape)
+                    else:
+                        out = np.empty(shape, dtype=np.float32)
+                start = offsets[futures[fut]]
+                if len(unique) == total:
+                    # Ingen duplikater: skriv batchen rett inn i sin del av matrisen
+                    block = out[start:start + len(embeddings)]
+                    block[:] = embeddings
+                    # Vektorisert L2-normalisering av alle rader i batchen
+                    block /= np.linalg.norm(block, axis=1, keepdims=True) + 1e-12
+                else:
+                    mat = np.asarray(embeddings, dtype=np.float32)
+                    mat /= np.linalg.norm(mat, axis=1, keepdims=True) + 1e-12
+                    dest = [positions[t] for t in unique[start:start + len(mat)]]
+                    out[[i for rows in dest for i in rows]] = np.repeat(mat, [len(r) for r in dest], axis=0)
+        except BaseException:
+            # Avbryt batcher som ikke er sendt ennå, så de ikke sendes (og faktureres)
+            # etter feilen, og fjern den halvskrevne memmap-filen
+            ex.shutdown(wait=False, cancel_futures=True)
+            out = None
+            if out_path is not None:
+                Path(out_path).unlink(missing_ok=True)
+            raise
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out  # type: ignore[return-value]
+
+
+# Parametre for TF‑IDF-byggingen; inngår i nøkkelen til fit-cachen
+_HASH_PARAMS: Dict[str, object] = {
+    "n_features": 2 ** 18,
+    "ngram_range": (1, 2),
+    "strip_accents": "unicode",
+    "lowercase": True,
+    "alternate_sign": False,
+    "norm": None,
+}
+_TFIDF_PARAMS: Dict[str, object] = {"norm": "l2", "sublinear_tf": True}
+
+
+def _fit_tfidf(texts: List[str]):
+    """
+    Bygg TF‑IDF i ett pass: `HashingVectorizer` (tilstandsløs, uten vokabular)
+    etterfulgt av `TfidfTransformer`. Returnerer sparse CSR-matrise.
+    """
+    hv = HashingVectorizer(**_HASH_PARAMS, dtype=np.float32)
+    tf = TfidfTransformer(**_TFIDF_PARAMS)
+    mtx = tf.fit_transform(hv.transform(texts)).tocsr()
+    return mtx
+
 
+def _fit_key(texts: List[str]) -> str:
+    """Innholdshash av tekstene og TF‑IDF-parametrene (nøkkel i fit-cachen)."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((sorted(_HASH_PARAMS.items()), sorted(_TFIDF_PARAMS.items()))).encode("utf-8"))
+    for t in texts:
+        b = t.encode("utf-8")
+        h.update(len(b).to_bytes(8, "little"))
+        h.update(b)
+    return h.hexdigest()
 
-def _build_tfidf_dense(chunks: List[Dict]) -> Tuple[np.ndarray, object]:
-    """Bygg TF‑IDF matrise og returner dens densere representasjon samt vectorizer."""
-    from sklearn.feature_extraction.text import TfidfVectorizer
-    import pickle
 
+def _fit_tfidf_cached(texts: List[str]):
+    """
+    `_fit_tfidf` memoisert på disk under `DATA_DIR/cache`. Kun siste tilpasning
+    beholdes (én `.npz` + nøkkelfil, ingen pickle), så cachen vokser ikke når
+    kunnskapsbasen endres; med uendrede tekster hoppes `fit_transform` over.
+    """
+    d = DATA_DIR / "cache"
+    key = _fit_key(texts)
+    try:
+        if (d / "tfidf_fit.key").read_text(encoding="utf-8").strip() == key:
+            return sparse.load_npz(d / "tfidf_fit.npz").tocsr()
+    except Exception:
+        pass
+    mtx = _fit_tfidf(texts)
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        # Nøkkelen fjernes først og skrives sist, så en avbrutt skriving aldri ser gyldig ut
+        (d / "tfidf_fit.key").unlink(missing_ok=True)
+        sparse.save_npz(d / "tfidf_fit.npz", mtx)
+        (d / "tfidf_fit.key").write_text(key, encoding="utf-8")
+    except Exception as e:
+        print(f"[ingest] Kunne ikke skrive TF-IDF-cache til {d}: {e}")
+    return mtx
+
+
+def _build_tfidf_sparse(chunks: List[Dict]):
+    """
+    Bygg TF‑IDF matrise og returner den som sparse CSR (float32).
+
+    TF‑IDF bruker `norm="l2"`, så radene er allerede enhetsnormert og
+    matrisen trenger verken fortetting eller egen normalisering. Retrieve
+    bygger sin egen spørringsindeks fra kildene, så vectorizeren lagres ikke.
+    Tilpasningen caches på innholdshash (se `_fit_tfidf_cached`), så en ny
+    bygging med uendret kunnskapsbase hopper over `fit_transform`.
+    """
     texts = [d["text"] for d in chunks] or [""]
-    vec = TfidfVectorizer(
-        ngram_range=(1, 2),
-        max_df=0.95,
-        strip_accents="unicode",
-        lowercase=True,
-        norm="l2",
-        sublinear_tf=True,
-        max_features=60000,
-    )
-    mtx = vec.fit_transform(texts)
-    dense = mtx.toarray()
-    norms = np.linalg.norm(dense, axis=1, keepdims=True)
-    dense = (dense / (norms + 1e-12)).astype("float32")
-    # Lagre vectorizer slik at den kan lastes senere hvis ønskelig
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
-    with (DATA_DIR / "vectorizer.pkl").open("wb") as f:
-        pickle.dump(vec, f)
-    return dense, vec
+    # Tilpass kun på unike tekster, og utvid til én rad per bit etterpå
+    unique = list(dict.fromkeys(texts))
+    mtx = _fit_tfidf_cached(unique)
+    if len(unique) != len(texts):
+        row_of = {t: i for i, t in enumerate(unique)}
+        mtx = mtx[[row_of[t] for t in texts]]
+    return mtx
 
 
-def _maybe_write_faiss(vectors: np.ndarray) -> None:
+def _maybe_write_faiss(vectors: np.ndarray, out_path: Path) -> bool:
     """
-    Skriv en FAISS-indeks til disk dersom `faiss` er tilgjengelig. Dersom
-    `faiss` ikke er installert, opprettes en tom fil slik at tester som
-    sjekker for `index.faiss` består. Skrives kun hvis det finnes
-    minst ett vektorpunkt.
+    Skriv en FAISS-indeks til disk for tette vektorer: flat indeks for små
+    korpus, HNSW fra `FAISS_HNSW_MIN_ROWS` rader og opp. Vektorene lagres som
+    float16 eller int8 (scalar quantizer, se `EMB_QUANT`), som gir halvparten
+    eller en firedel av minnet og båndbredden ved søk; rangeringen påvirkes
+    kun innenfor avrundingsstøy.
+    Vektorene er L2-normalisert, så indre produkt tilsvarer cosinus.
+    Returnerer False (og skriver ingen fil) dersom `faiss` ikke er installert.
     """
-    out_path = DATA_DIR / "index.faiss"
-    if vectors.size == 0:
-        # Ingen data – skriv en tom fil for å indikere at det ikke er noen indeks
-        out_path.touch()
-        return
     if faiss is None:
-        # Biblioteket er ikke tilgjengelig; opprett en tom fil
-        out_path.touch()
-        return
-    idx = faiss.IndexFlatIP(vectors.shape[1])
-    idx.add(vectors)
+        print("[ingest] faiss er ikke installert – hopper over index.faiss.")
+        return False
+    n, d = vectors.shape
+    qt = faiss.ScalarQuantizer.QT_8bit if EMB_QUANT == "int8" else faiss.ScalarQuantizer.QT_fp16
+    if n < FAISS_HNSW_MIN_ROWS:
+        idx = faiss.IndexScalarQuantizer(d, qt, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # Store korpus: HNSW gir tilnærmet nærmeste nabo i logaritmisk tid
+        idx = faiss.IndexHNSWSQ(d, qt, 32, faiss.METRIC_INNER_PRODUCT)
+        idx.hnsw.efConstruction = 200
+        # Lagres i indeksfilen; retrieve øker den ved behov per søk
+        idx.hnsw.efSearch = 64
+    if vectors.size > 0:
+        X = np.ascontiguousarray(vectors, dtype=np.float32)
+        if not idx.is_trained:
+            idx.train(X)
+        idx.add(X)
     faiss.write_index(idx, str(out_path))
+    return True
 
 
-def build_index(kb_dir: str | Path = KB_DIR_DEFAULT) -> None:
+def _load_previous_embeddings() -> Tuple[Dict[str, Tuple[str, int]], Optional[np.ndarray]]:
+    """
+    Last forrige OpenAI-indeks fra `DATA_DIR` for inkrementell bygging.
+
+    Returnerer ({id: (hash, rad)}, vektorer). Kun rader embeddet med samme
+    `EMBED_MODEL` tas med; mangler eller ugyldige artefakter gir ({}, None).
+    """
+    vec_path = DATA_DIR / "vectors.npy"
+    meta_path = DATA_DIR / "meta.jsonl"
+    if not vec_path.exists() or not meta_path.exists():
+        return {}, None
+    lookup: Dict[str, Tuple[str, int]] = {}
+    try:
+        # Ingen mmap: filen overskrives når den nye indeksen lagres
+        old = np.load(vec_path, allow_pickle=False)
+        meta = read_jsonl(meta_path)
+        rows = len(meta)
+        for row, m in enumerate(meta):
+            if m.get("embed_model") == EMBED_MODEL and m.get("hash"):
+                lookup[m["id"]] = (m["hash"], row)
+    except Exception:
+        return {}, None
+    if old.ndim != 2 or old.shape[0] != rows:
+        return {}, None
+    return lookup, old
+
+
+def _embed_incremental(
+    chunks: List[Dict], force: bool = False, out_path: Optional[Path] = None
+) -> np.ndarray:
+    """
+    Bygg OpenAI-embeddings, men gjenbruk rader fra forrige indeks for biter
+    med uendret id og innholdshash. Kun nye/endrede biter sendes til API-et.
+    Med `out_path` skrives resultatet til en memory-mappet `.npy`-fil.
+    """
+    for c in chunks:
+        c["embed_model"] = EMBED_MODEL
+    lookup, old = ({}, None) if force else _load_previous_embeddings()
+    rows: List[Optional[int]] = []
+    for c in chunks:
+        prev = lookup.get(c["id"])
+        rows.append(prev[1] if prev and prev[0] == c["hash"] else None)
+    new_idx = [i for i, r in enumerate(rows) if r is None]
+    if old is None or len(new_idx) == len(chunks):
+        return _build_openai_embeddings(chunks, out_path=out_path)
+    # Uendret korpus: ingen API-kall (og ingen nøkkel eller klient nødvendig)
+    new_vecs = _build_openai_embeddings([chunks[i] for i in new_idx]) if new_idx else None
+    print(f"[ingest] Gjenbruker {len(chunks) - len(new_idx)} av {len(chunks)} embeddings.")
+    shape = (len(chunks), old.shape[1])
+    if out_path is not None:
+        vectors = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.float32, shape=shape)
+    else:
+        vectors = np.empty(shape, dtype=np.float32)
+    reuse_idx = [i for i, r in enumerate(rows) if r is not None]
+    vectors[reuse_idx] = old[[rows[i] for i in reuse_idx]]
+    if new_idx:
+        vectors[new_idx] = new_vecs
+    if isinstance(vectors, np.memmap):
+        vectors.flush()
+    return vectors
+
+
+def build_index(kb_dir: str | Path = KB_DIR_DEFAULT, force: bool = False) -> None:
     """
     Bygg indeks fra dokumentene i `kb_dir`.
 
-    Les alle dokumentene, del dem i biter, bygg enten OpenAI‑embeddings eller
-    TF‑IDF‑vektorer, normaliser vektorene og skriv dem til
-    `DATA_DIR/vectors.npy`. Metadata skrives til `DATA_DIR/meta.jsonl`.
-    Dersom `faiss` er tilgjengelig, skrives i tillegg `index.faiss`.
+    Les alle dokumentene, del dem i biter og bygg enten OpenAI‑embeddings
+    (tett, `DATA_DIR/vectors.npy`) eller TF‑IDF‑vektorer (sparse CSR,
+    `DATA_DIR/vectors.npz`). Metadata skrives til `DATA_DIR/meta.jsonl`.
+    For OpenAI skrives i tillegg `index.faiss` dersom `faiss` er tilgjengelig.
+
+    OpenAI-embeddings bygges inkrementelt: biter med uendret innhold gjenbrukes
+    fra forrige indeks. Sett `force=True` (eller `FORCE_REBUILD=1`) for å
+    embedde alt på nytt.
     """
     kb_root = Path(kb_dir)
-    chunks = _iter_docs(kb_root)
+    chunks = list(_iter_docs(kb_root))
     if USE_OPENAI:
-        vectors = _build_openai_embeddings(chunks)
-        # Lagre vektorene
         DATA_DIR.mkdir(parents=True, exist_ok=True)
-        np.save(DATA_DIR / "vectors.npy", vectors)
-        _save_meta(chunks)
-        _maybe_write_faiss(vectors)
+        vec_path = DATA_DIR / "vectors.npy"
+        # Vektorene skrives memory-mappet til en midlertidig fil mens embeddings
+        # hentes, og byttes inn først når alt er ferdig (aldri halvskrevet indeks)
+        tmp_path = DATA_DIR / "vectors.tmp.npy"
+        meta_tmp = DATA_DIR / "meta.tmp.jsonl"
+        faiss_tmp = DATA_DIR / "index.tmp.faiss"
+        sig_tmp = DATA_DIR / "index.tmp.sig"
+        try:
+            vectors = _embed_incremental(
+                chunks, force=force or env_flag("FORCE_REBUILD", False), out_path=tmp_path
+            )
+            if not isinstance(vectors, np.memmap):
+                # Alltid en sammenhengende float32-matrise uten pickle (mmap-vennlig)
+                vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+                np.save(tmp_path, vectors, allow_pickle=False)
+            # FP16-kopien fra eldre bygginger brukes ikke lenger (FAISS kvantiserer selv)
+            (DATA_DIR / "vectors_f16.npy").unlink(missing_ok=True)
+            (DATA_DIR / "vectors.npz").unlink(missing_ok=True)
+            _save_meta(chunks, meta_tmp)
+            has_faiss = _maybe_write_faiss(vectors, faiss_tmp)
+            if has_faiss:
+                sig_tmp.write_text(index_signature(chunks), encoding="utf-8")
+            # Slipp mappingen før filen erstattes (påkrevd på Windows)
+            del vectors
+            # Metadataene byttes inn etter vektorene, så ny meta.jsonl aldri
+            # ligger ved siden av gamle vektorer
+            os.replace(tmp_path, vec_path)
+            os.replace(meta_tmp, DATA_DIR / "meta.jsonl")
+            # FAISS-indeksen byttes inn sist og signaturen aller sist: retrieve
+            # bruker kun en indeks hvis signaturen stemmer med meta.jsonl, så en
+            # gammel indeks kan aldri kobles til nye metadatarader
+            if has_faiss:
+                os.replace(faiss_tmp, DATA_DIR / "index.faiss")
+                os.replace(sig_tmp, DATA_DIR / "index.sig")
+            else:
+                (DATA_DIR / "index.sig").unlink(missing_ok=True)
+                (DATA_DIR / "index.faiss").unlink(missing_ok=True)
+        except BaseException:
+            # Ingen halvskrevne midlertidige filer etter en feilet bygging
+            for p in (tmp_path, meta_tmp, faiss_tmp, sig_tmp):
+                p.unlink(missing_ok=True)
+            raise
         print(
             f"[ingest] OpenAI-embeddings for {len(chunks)} biter skrevet til {DATA_DIR}/vectors.npy og {DATA_DIR}/meta.jsonl."
         )
     else:
-        vectors, _ = _build_tfidf_dense(chunks)
+        mtx = _build_tfidf_sparse(chunks)
         DATA_DIR.mkdir(parents=True, exist_ok=True)
-        np.save(DATA_DIR / "vectors.npy", vectors)
+        sparse.save_npz(DATA_DIR / "vectors.npz", mtx.astype(np.float32))
+        # Fjern tett vektorfil/FAISS-indeks fra en tidligere OpenAI-bygging
+        (DATA_DIR / "vectors.npy").unlink(missing_ok=True)
+        (DATA_DIR / "vectors_f16.npy").unlink(missing_ok=True)
+        (DATA_DIR / "index.faiss").unlink(missing_ok=True)
+        (DATA_DIR / "index.sig").unlink(missing_ok=True)
+        # Vectorizer-artefakter fra eldre bygginger leses ikke av noe
+        for name in ("vectorizer.pkl", "vectorizer.json", "idf.npy"):
+            (DATA_DIR / name).unlink(missing_ok=True)
         _save_meta(chunks)
-        _maybe_write_faiss(vectors)
         print(
-            f"[ingest] TF-IDF vektorer for {len(chunks)} biter skrevet til {DATA_DIR}/vectors.npy og {DATA_DIR}/meta.jsonl."
+            f"[ingest] TF-IDF vektorer for {len(chunks)} biter skrevet til {DATA_DIR}/vectors.npz og {DATA_DIR}/meta.jsonl."
         )
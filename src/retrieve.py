@@ -17,32 +17,98 @@ Basert på RAG‑Asker‑Tennis, men tilpasset Asker Fotball.
 
 from __future__ import annotations
 
+import hashlib
 import json
 import os
 import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Iterable, Optional
+from typing import Any, Dict, List, Iterable, Optional, Tuple, TYPE_CHECKING
 
 import numpy as np
 
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import linear_kernel
+from src.score import cosine_scores
+from src.utils import (
+    _read_text_file,
+    compile_triggers,
+    env_flag,
+    index_signature,
+    iter_files,
+    iter_jsonl,
+    match_groups,
+    read_jsonl,
+)
 
-from src.utils import env_flag
+try:
+    import faiss  # type: ignore
+except Exception:
+    faiss = None  # type: ignore
+
+# sklearn og scipy.sparse importeres først når TF‑IDF-indeksen trengs (de
+# koster flere hundre ms ved import, også for prosesser som aldri søker)
+if TYPE_CHECKING:  # pragma: no cover - kun for typehinting
+    from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
 
 # --- Konfig ---
 # Søk i både kb/ og eventuelt forhåndsprosesserte data under data/processed
 KB_DIRS: List[Path] = [Path("kb"), Path("data/processed")]
 CHUNK_SIZE = 700
 CHUNK_OVERLAP = 120
+# Maks antall tråder som leser kildefiler parallelt i _load_files
+_LOAD_WORKERS = 16
 
 DATA_DIR: Path = Path(os.getenv("DATA_DIR", "data"))
-USE_OPENAI: bool = env_flag("USE_OPENAI", False)
-EMBED_MODEL: str = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+# Minste efSearch for HNSW-indekser (se `_faiss_search`)
+_HNSW_EF_SEARCH = 64
+
+# TF‑IDF-indeksen caches på disk her, gyldig så lenge kildefilene er uendret
+TFIDF_CACHE_DIR: Path = DATA_DIR / "tfidf_cache"
+# Filer i cachen fra eldre formater (vokabular fra før HashingVectorizer); slettes ved skriving
+_STALE_CACHE_FILES = ("vocab.json",)
+# TF‑IDF bygges som HashingVectorizer (tilstandsløs, uten vokabular) +
+# TfidfTransformer; kun idf-vektoren og matrisen må lagres
+_HASH_PARAMS: Dict[str, Any] = {
+    "n_features": 2 ** 18,
+    "ngram_range": (1, 2),
+    "strip_accents": "unicode",
+    "lowercase": True,
+    "alternate_sign": False,
+    "norm": None,
+}
+_TFIDF_PARAMS: Dict[str, Any] = {
+    "norm": "l2",
+    "sublinear_tf": True,
+}
+
+
+@lru_cache(maxsize=1)
+def _hashing_vectorizer() -> "HashingVectorizer":
+    """Den delte (tilstandsløse) HashingVectorizer-en, opprettet ved første bruk."""
+    from sklearn.feature_extraction.text import HashingVectorizer
+
+    return HashingVectorizer(**_HASH_PARAMS, dtype=np.float32)
+
+
+def _use_openai() -> bool:
+    """
+    OpenAI-modus: `USE_OPENAI` leses ved hvert kall, så flagget kan slås av
+    i kjøretid uten ny import. Krever en klient.
+    """
+    return env_flag("USE_OPENAI", False) and _openai is not None
+
+
+def _embed_model() -> str:
+    """Embedding-modell for spørringer (`EMBED_MODEL`), lest ved kall."""
+    return os.getenv("EMBED_MODEL", "text-embedding-3-small")
+
 
-# OpenAI-klient (brukes kun hvis USE_OPENAI)
+# OpenAI-klient (opprettes kun hvis USE_OPENAI er satt ved import)
 _openai = None
-if USE_OPENAI:
+if env_flag("USE_OPENAI", False):
     try:
         from openai import OpenAI  # type: ignore
         api_key = os.getenv("OPENAI_API_KEY")
@@ -54,43 +120,140 @@ if USE_OPENAI:
     except Exception:
         _openai = None
 
+# Markør for felt som mangler i en rad (skilles fra en eksplisitt None)
+_MISSING = object()
+
+
+class _MetaTable:
+    """
+    Metadata for indeksradene lagret kolonnevis (én NumPy-array per felt) i
+    stedet for én dict per rad. Doc_type lagres som int8-koder og rene
+    heltallsfelt som int32; dicts bygges først for radene som returneres.
+    """
+
+    __slots__ = ("_n", "_cols", "_cats")
+
+    def __init__(self, rows: Iterable[Dict]) -> None:
+        rows = list(rows)
+        self._n = len(rows)
+        self._cols: Dict[str, np.ndarray] = {}
+        self._cats: Dict[str, List[Any]] = {}
+        for key in dict.fromkeys(k for r in rows for k in r):
+            values = [r.get(key, _MISSING) for r in rows]
+            if key == "doc_type":
+                cats = list(dict.fromkeys(values))
+                if len(cats) <= 127:
+                    codes = {c: i for i, c in enumerate(cats)}
+                    self._cats[key] = cats
+                    self._cols[key] = np.fromiter((codes[v] for v in values), dtype=np.int8, count=self._n)
+                    continue
+            if all(type(v) is int and -(2 ** 31) <= v < 2 ** 31 for v in values):
+                self._cols[key] = np.asarray(values, dtype=np.int32)
+                continue
+            col = np.empty(self._n, dtype=object)
+            for i, v in enumerate(values):
+                col[i] = v
+            self._cols[key] = col
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __iter__(self):
+        return iter(self.rows(np.arange(self._n)))
+
+    def rows(self, order: np.ndarray) -> List[Dict]:
+        """Dicts for radene i `order` (i den rekkefølgen); kolonnene indekseres vektorisert."""
+        idx = np.asarray(order, dtype=np.intp)
+        picked = []
+        for key, col in self._cols.items():
+            vals = col[idx].tolist()
+            cats = self._cats.get(key)
+            if cats is not None:
+                vals = [cats[c] for c in vals]
+            elif col.dtype == object:
+                # Lister (f.eks. `aliases`) kopieres, så treff ikke deler dem med indeksen
+                vals = [list(v) if type(v) is list else v for v in vals]
+            picked.append((key, vals))
+        out: List[Dict] = []
+        for j in range(idx.size):
+            out.append({key: vals[j] for key, vals in picked if vals[j] is not _MISSING})
+        return out
+
+
 # TF‑IDF state
-_VEC: Optional[TfidfVectorizer] = None
-_MTX = None  # scipy sparse matrix
-_META: List[Dict] = []  # én entry per rad i _MTX
+_TF: Optional[TfidfTransformer] = None  # tilpasset idf for korpuset
+_MTX = None  # scipy sparse CSR-matrise (float32, L2-normaliserte rader)
+_MTX_T = None  # _MTX transponert som CSR (termer × biter), brukes ved søk
+_META = _MetaTable([])  # én rad per rad i _MTX
 
 # OpenAI state
 _EMB: Optional[np.ndarray] = None  # shape (n_chunks, dim)
-_META_OAI: List[Dict] = []
+_META_OAI = _MetaTable([])
+_FAISS = None  # faiss.Index over _EMB (index.faiss), hvis tilgjengelig
+
+# Søkecache: (spørring, k, modus, epoke) -> treff. Epoken økes hver gang en
+# indeks lastes eller bygges, så gamle treff aldri returneres etter ny indeks.
+_CACHE_MAX = 512
+_QUERY_CACHE: "OrderedDict[tuple, List[Dict]]" = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+_INDEX_EPOCH = 0
+
+# Disk-cache (SQLite) for spørrings-embeddings, åpnes ved første bruk
+_QEMB_DB: Optional[sqlite3.Connection] = None
+_QEMB_LOCK = threading.Lock()
 
 
 # ---------- Utils ----------
 
 
-def _read_text_file(p: Path) -> str:
-    try:
-        return p.read_text(encoding="utf-8", errors="ignore")
-    except Exception:
-        return ""
+# Regex kompileres én gang ved import i stedet for per dokument
+_CODEFENCE_RE = re.compile(r"```.*?```", re.S)
+_H1_RE = re.compile(r"^\s*#\s+(.+)$", re.M)
+# Linjeskift slik `str.splitlines` definerer dem
+_LINE_BREAK_RE = re.compile("[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+# Nøkkelord per dokumenttype, i prioritert rekkefølge (første treff vinner)
+_DOC_TYPE_KEYWORDS: Dict[str, Tuple[str, ...]] = {
+    # Billett / sesongkort / pris
+    "billett": ("billett", "billetter", "sesongkort", "foyka+", "foyka plus", "pris", "kostnad", "inngang", "adgang"),
+    # Terminliste, kamper, resultater, tabell
+    "terminliste": ("terminliste", "kamp", "kamper", "resultat", "resultater", "tabell", "serie", "postnord"),
+    # Kontaktinformasjon
+    "kontakt": ("kontakt", "telefon", "tlf", "mail", "e-post", "epost", "adresse", "kirkeveien", "postadresse"),
+    # Samfunn / gatelag / united
+    "samfunn": ("samfunn", "gatelag", "asker united", "hæppe", "brobygger", "samfunnslag", "aktivt lokalsamfunn", "sammen for fotball"),
+    # Historie og fakta
+    "historie": ("historie", "historisk", "stiftet", "grunnlagt", "rekord", "adelskalender", "fakta", "spillere", "topp", "legender"),
+    # Stadion, arena, fasiliteter, parkering
+    "stadion": ("stadion", "føyka", "foyka", "fotballhuset", "tribune", "kapasitet", "parkering", "vip", "medie"),
+    # Lag, spillere, trener
+    "lag": ("a-lag", "spillere", "keeper", "forsvar", "midtbane", "angrep", "trener", "spillertropp", "lag"),
+    # Marked / sponsor
+    "marked": ("marked", "partner", "sponsor", "synlighet", "nettverk", "sponsoravtale"),
+    # Aktivitet / akademi / camp
+    "aktivitet": ("akademi", "camp", "obos", "trening", "aktivitet", "kurs", "leir"),
+}
+_DOC_TYPE_MATCHER, _DOC_TYPE_LABELS = compile_triggers(_DOC_TYPE_KEYWORDS)
 
 
 def _strip_markdown_noise(txt: str) -> str:
-    # Fjern codefences og komprimer whitespace
-    txt = re.sub(r"```.*?```", " ", txt, flags=re.S)
-    txt = re.sub(r"\s+", " ", txt)
-    return txt.strip()
+    # Fjern codefences (sjelden, så hopp over regex ellers) og komprimer whitespace
+    if "```" in txt:
+        txt = _CODEFENCE_RE.sub(" ", txt)
+    return " ".join(txt.split())
 
 
 def _title_from_markdown(txt: str, fallback: str) -> str:
     """Hent første overskrift (h1) som tittel, eller bruk fallback."""
-    m = re.search(r"^\s*#\s+(.+)$", txt, flags=re.M)
+    m = _H1_RE.search(txt)
     if m:
         return m.group(1).strip()
-    for line in txt.splitlines():
-        s = line.strip()
-        if s:
-            return s[:120]
-    return fallback
+    # Første ikke-tomme linje, uten å dele opp hele teksten i linjer
+    s = txt.lstrip()
+    if not s:
+        return fallback
+    m = _LINE_BREAK_RE.search(s)
+    return (s[: m.start()] if m else s).strip()[:120]
 
 
 def _infer_doc_type(name: str, text: str) -> str:
@@ -98,36 +261,14 @@ def _infer_doc_type(name: str, text: str) -> str:
     Grov inndeling av dokumenttyper for rangering. Basert på nøkkelord i filnavn og innhold.
 
     Avkast "billett", "terminliste", "kontakt", "samfunn", "historie",
-    "stadion", "lag", "marked", "aktivitet" eller "annet".
+    "stadion", "lag", "marked", "aktivitet" eller "annet". Alle nøkkelord
+    matches i ett pass; ved flere treff vinner typen som står først.
     """
     low = (name + " " + text[:400]).lower()
-    # Billett / sesongkort / pris
-    if any(w in low for w in ["billett", "billetter", "sesongkort", "foyka+", "foyka plus", "pris", "kostnad", "inngang", "adgang"]):
-        return "billett"
-    # Terminliste, kamper, resultater, tabell
-    if any(w in low for w in ["terminliste", "kamp", "kamper", "resultat", "resultater", "tabell", "serie", "postnord"]):
-        return "terminliste"
-    # Kontaktinformasjon
-    if any(w in low for w in ["kontakt", "telefon", "tlf", "mail", "e-post", "epost", "adresse", "kirkeveien", "postadresse"]):
-        return "kontakt"
-    # Samfunn / gatelag / united
-    if any(w in low for w in ["samfunn", "gatelag", "asker united", "hæppe", "brobygger", "samfunnslag", "aktivt lokalsamfunn", "sammen for fotball"]):
-        return "samfunn"
-    # Historie og fakta
-    if any(w in low for w in ["historie", "historisk", "stiftet", "grunnlagt", "rekord", "adelskalender", "fakta", "spillere", "topp", "legender"]):
-        return "historie"
-    # Stadion, arena, fasiliteter, parkering
-    if any(w in low for w in ["stadion", "føyka", "foyka", "fotballhuset", "tribune", "kapasitet", "parkering", "vip", "medie"]):
-        return "stadion"
-    # Lag, spillere, trener
-    if any(w in low for w in ["a-lag", "spillere", "keeper", "forsvar", "midtbane", "angrep", "trener", "spillertropp", "lag"]):
-        return "lag"
-    # Marked / sponsor
-    if any(w in low for w in ["marked", "partner", "sponsor", "synlighet", "nettverk", "sponsoravtale"]):
-        return "marked"
-    # Aktivitet / akademi / camp
-    if any(w in low for w in ["akademi", "camp", "obos", "trening", "aktivitet", "kurs", "leir"]):
-        return "aktivitet"
+    found = match_groups(low, _DOC_TYPE_MATCHER, _DOC_TYPE_LABELS)
+    for doc_type in _DOC_TYPE_KEYWORDS:
+        if doc_type in found:
+            return doc_type
     return "annet"
 
 
@@ -136,17 +277,13 @@ def _chunk(text: str, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> L
     text = text.strip()
     if not text:
         return []
-    chunks: List[str] = []
-    i = 0
     n = len(text)
-    while i < n:
-        j = min(i + size, n)
-        chunk = text[i:j]
-        chunks.append(chunk)
-        if j == n:
-            break
-        i = max(j - overlap, 0)
-    return chunks
+    # Startposisjonene er en aritmetisk rekke; beregn alle vinduer i ett NumPy-kall
+    starts = np.arange(0, n, size - overlap, dtype=np.int64)
+    ends = np.minimum(starts + size, n)
+    # Stopp etter første vindu som når tekstslutt (resten er dekket av det)
+    last = int(np.argmax(ends == n))
+    return [text[s:e] for s, e in zip(starts[: last + 1].tolist(), ends[: last + 1].tolist())]
 
 
 def _iter_kb_files() -> Iterable[Path]:
@@ -155,112 +292,391 @@ def _iter_kb_files() -> Iterable[Path]:
     for d in KB_DIRS:
         if not d.exists():
             continue
-        for p in d.rglob("*.md"):
-            if p.is_file():
-                seen.add(p.resolve())
-        for p in d.rglob("*.jsonl"):
-            if p.is_file():
-                seen.add(p.resolve())
+        for entry in iter_files(d):
+            if entry.name.endswith((".md", ".jsonl")):
+                seen.add(Path(entry.path).resolve())
     for p in sorted(seen):
         yield Path(p)
 
 
-def _load_corpus() -> List[Dict]:
-    """Last hele korpuset og del i biter med metadata."""
+@lru_cache(maxsize=4096)
+def _md_file_parts(path_str: str, mtime_ns: int, size: int) -> Tuple[str, str, Tuple[str, ...]]:
+    """
+    (tittel, doc_type, biter) for én markdown-fil. Memoisert på (sti, mtime,
+    størrelse), så gjentatte bygginger i samme prosess hopper over lesing,
+    regex-rensing og oppdeling for uendrede filer.
+    """
+    p = Path(path_str)
+    raw = _read_text_file(p)
+    clean = _strip_markdown_noise(raw)
+    title = _title_from_markdown(raw, p.stem.replace("-", " "))
+    doc_type = _infer_doc_type(p.name, clean)
+    return title, doc_type, tuple(_chunk(clean))
+
+
+def _md_docs(p: Path) -> List[Dict]:
+    """Del én markdown-fil i biter med metadata."""
+    source_path = str(p).replace("\\", "/")
+    try:
+        st = p.stat()
+    except OSError:
+        return []
+    title, doc_type, chunks = _md_file_parts(str(p), st.st_mtime_ns, st.st_size)
+    return [
+        {
+            "text": ch,
+            "source": source_path,
+            "title": title,
+            "doc_type": doc_type,
+            "version_date": None,
+            "page": None,
+            "chunk_idx": ci,
+            "id": f"{source_path}#{ci}",
+        }
+        for ci, ch in enumerate(chunks)
+    ]
+
+
+def _jsonl_docs(p: Path) -> List[Dict]:
+    """Les forhåndsprosesserte dokumenter (én JSON per linje) fra en jsonl-fil."""
+    source_path = str(p).replace("\\", "/")
     docs: List[Dict] = []
-    for p in _iter_kb_files():
-        source_path = str(p).replace("\\", "/")
-        if p.suffix.lower() == ".md":
-            raw = _read_text_file(p)
-            clean = _strip_markdown_noise(raw)
-            title = _title_from_markdown(raw, p.stem.replace("-", " "))
-            doc_type = _infer_doc_type(p.name, clean)
-            chunks = _chunk(clean)
-            for ci, ch in enumerate(chunks):
-                docs.append({
-                    "text": ch,
-                    "source": source_path,
-                    "title": title,
-                    "doc_type": doc_type,
-                    "version_date": None,
-                    "page": None,
-                    "chunk_idx": ci,
-                    "id": f"{source_path}#{ci}",
-                })
-        elif p.suffix.lower() == ".jsonl":
-            ci = 0
-            for line in _read_text_file(p).splitlines():
-                line = line.strip()
-                if not line:
-                    continue
-                try:
-                    obj = json.loads(line)
-                except Exception:
-                    continue
-                txt = obj.get("text", "")
-                meta = obj.get("metadata", {})
-                if not txt.strip():
-                    continue
-                txt_clean = _strip_markdown_noise(txt)
-                title = meta.get("title") or _title_from_markdown(txt, Path(meta.get("source", p.stem)).stem)
-                doc_type = meta.get("doc_type") or _infer_doc_type(title, txt)
-                src = (meta.get("source") or source_path).replace("\\", "/")
-                page = meta.get("page")
-                docs.append({
-                    "text": txt_clean,
-                    "source": src,
-                    "title": title,
-                    "doc_type": doc_type,
-                    "version_date": meta.get("version_date"),
-                    "page": page,
-                    "chunk_idx": ci,
-                    "id": f"{Path(src).as_posix()}#{ci}",
-                })
-                ci += 1
+    ci = 0
+    try:
+        # Strømmes linje for linje (orjson hvis installert); ugyldige linjer hoppes over
+        for obj in iter_jsonl(p, skip_invalid=True):
+            txt = obj.get("text", "")
+            meta = obj.get("metadata", {})
+            if not txt.strip():
+                continue
+            txt_clean = _strip_markdown_noise(txt)
+            title = meta.get("title") or _title_from_markdown(txt, Path(meta.get("source", p.stem)).stem)
+            doc_type = meta.get("doc_type") or _infer_doc_type(title, txt)
+            src = (meta.get("source") or source_path).replace("\\", "/")
+            page = meta.get("page")
+            docs.append({
+                "text": txt_clean,
+                "source": src,
+                "title": title,
+                "doc_type": doc_type,
+                "version_date": meta.get("version_date"),
+                "page": page,
+                "chunk_idx": ci,
+                "id": f"{Path(src).as_posix()}#{ci}",
+            })
+            ci += 1
+    except OSError:
+        pass
     return docs
 
 
+def _process_one_file(p: Path) -> List[Dict]:
+    """Biter fra én kildefil (markdown eller jsonl); andre filtyper gir tom liste."""
+    suffix = p.suffix.lower()
+    if suffix == ".md":
+        return _md_docs(p)
+    if suffix == ".jsonl":
+        return _jsonl_docs(p)
+    return []
+
+
+def _load_files(paths: List[Path]) -> List[List[Dict]]:
+    """
+    Biter for hver fil i `paths` (samme rekkefølge). Filene leses i en
+    trådpool (fillesing slipper GIL-en), og `map` bevarer rekkefølgen.
+    """
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=min(_LOAD_WORKERS, len(paths))) as ex:
+        return list(ex.map(_process_one_file, paths))
+
+
 # ---------- Indeksering ----------
 
 
-def _ensure_index_tfidf() -> None:
-    """Lazy bygging av TF‑IDF indeks ved første kall."""
-    global _VEC, _MTX, _META
-    if _VEC is not None and _MTX is not None and _META:
-        return
-    corpus = _load_corpus()
-    _META = corpus
-    texts = [d["text"] for d in corpus]
-    if not texts:
-        # ingen dokumenter; opprett tom vectorizer for å unngå crash
-        _VEC = TfidfVectorizer(ngram_range=(1, 2), max_features=1000)
-        _MTX = _VEC.fit_transform([""])
-        return
-    _VEC = TfidfVectorizer(
-        ngram_range=(1, 2),
-        max_df=0.95,
-        min_df=1,
-        strip_accents="unicode",
-        lowercase=True,
-        norm="l2",
-        sublinear_tf=True,
-        max_features=60000,
+def _params_signature() -> str:
+    """Signatur for oppdelings- og hashing-parametrene (bestemmer tellematrisen per fil)."""
+    params = (CHUNK_SIZE, CHUNK_OVERLAP, sorted(_HASH_PARAMS.items()))
+    return hashlib.blake2b(repr(params).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _corpus_signature() -> str:
+    """
+    Signatur for kunnskapsbasen: hash av (sti, mtime, størrelse) for hver
+    kildefil, pluss oppdelings- og vectorizer-parametre.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((_params_signature(), sorted(_TFIDF_PARAMS.items()))).encode("utf-8"))
+    for p in _iter_kb_files():
+        st = p.stat()
+        h.update(f"{p.as_posix()}\0{st.st_mtime_ns}\0{st.st_size}\n".encode("utf-8"))
+    return h.hexdigest()
+
+
+def _dedupe_chunks(corpus: List[Dict]) -> Tuple[List[Dict], List[int]]:
+    """
+    Fjern biter med identisk tekst (f.eks. samme dokument som både .md og
+    jsonl) før TF‑IDF tilpasses, så de ikke gir ekstra rader eller teller
+    dobbelt i idf. Første forekomst beholdes; id-ene til duplikatene legges
+    i `aliases` på (en kopi av) den, så alle kilder fortsatt følger med treffet.
+    Returnerer (unike biter, deres posisjoner i `corpus`).
+    """
+    seen: Dict[bytes, int] = {}
+    out: List[Dict] = []
+    keep: List[int] = []
+    for i, d in enumerate(corpus):
+        h = hashlib.blake2b(d["text"].encode("utf-8"), digest_size=16).digest()
+        j = seen.get(h)
+        if j is None:
+            seen[h] = len(out)
+            out.append(d)
+            keep.append(i)
+        else:
+            if "aliases" not in out[j]:
+                out[j] = {**out[j], "aliases": []}
+            out[j]["aliases"].append(d["id"])
+    return out, keep
+
+
+def _load_file_cache() -> Dict[str, Tuple[int, int, Any, List[Dict]]]:
+    """
+    Per-fil-resultater fra forrige bygging i `TFIDF_CACHE_DIR`: sti ->
+    (mtime_ns, størrelse, rå tellematrise, biter). Tom dict hvis cachen
+    mangler, er ugyldig eller ble bygget med andre parametre.
+    """
+    d = TFIDF_CACHE_DIR
+    try:
+        from scipy import sparse
+
+        manifest = json.loads((d / "manifest.json").read_text(encoding="utf-8"))
+        if manifest.get("params") != _params_signature():
+            return {}
+        counts = sparse.load_npz(d / "counts.npz").tocsr()
+        chunks = read_jsonl(d / "chunks.jsonl")
+        if counts.shape[0] != len(chunks):
+            return {}
+        return {
+            path: (mtime_ns, size, counts[start:end], chunks[start:end])
+            for path, mtime_ns, size, start, end in manifest["files"]
+        }
+    except Exception:
+        return {}
+
+
+def _save_file_cache(files: List[Tuple[str, int, int, int, int]], counts, chunks: List[Dict]) -> None:
+    """Skriv per-fil-manifest, rå tellematrise og biter (før deduplisering). Feil logges og ignoreres."""
+    from scipy import sparse
+
+    d = TFIDF_CACHE_DIR
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        # Manifestet fjernes først og skrives sist, så en avbrutt skriving aldri ser gyldig ut
+        (d / "manifest.json").unlink(missing_ok=True)
+        sparse.save_npz(d / "counts.npz", counts)
+        with (d / "chunks.jsonl").open("w", encoding="utf-8") as f:
+            for m in chunks:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        manifest = {"params": _params_signature(), "files": files}
+        (d / "manifest.json").write_text(json.dumps(manifest, ensure_ascii=False), encoding="utf-8")
+    except Exception as e:
+        print(f"[retrieve] Kunne ikke skrive per-fil-cache til {d}: {e}")
+
+
+def _load_tfidf_cache(sig: str) -> Optional[Tuple[TfidfTransformer, Any, _MetaTable]]:
+    """Last TF‑IDF-indeksen fra `TFIDF_CACHE_DIR` hvis signaturen stemmer, ellers None."""
+    d = TFIDF_CACHE_DIR
+    try:
+        if (d / "sig.txt").read_text(encoding="utf-8").strip() != sig:
+            return None
+        from scipy import sparse
+        from sklearn.feature_extraction.text import TfidfTransformer
+
+        tf = TfidfTransformer(**_TFIDF_PARAMS)
+        tf.idf_ = np.load(d / "idf.npy", allow_pickle=False)
+        mtx = sparse.load_npz(d / "matrix.npz").tocsr()
+        meta = _MetaTable(read_jsonl(d / "meta.jsonl"))
+    except Exception:
+        return None
+    if mtx.shape[0] != len(meta):
+        return None
+    return tf, mtx, meta
+
+
+def _save_tfidf_cache(sig: str, tf: TfidfTransformer, mtx, meta: List[Dict]) -> None:
+    """
+    Skriv TF‑IDF-indeksen til `TFIDF_CACHE_DIR` (uten pickle) og fjern filer
+    fra eldre cacheformater. Feil logges og ignoreres.
+    """
+    from scipy import sparse
+
+    d = TFIDF_CACHE_DIR
+    try:
+        d.mkdir(parents=True, exist_ok=True)
+        # Signaturen fjernes først og skrives sist, så en avbrutt skriving aldri ser gyldig ut
+        (d / "sig.txt").unlink(missing_ok=True)
+        for name in _STALE_CACHE_FILES:
+            (d / name).unlink(missing_ok=True)
+        np.save(d / "idf.npy", tf.idf_.astype(np.float32), allow_pickle=False)
+        sparse.save_npz(d / "matrix.npz", mtx)
+        with (d / "meta.jsonl").open("w", encoding="utf-8") as f:
+            for m in meta:
+                f.write(json.dumps(m, ensure_ascii=False) + "\n")
+        (d / "sig.txt").write_text(sig, encoding="utf-8")
+    except Exception as e:
+        print(f"[retrieve] Kunne ikke skrive TF-IDF-cache til {d}: {e}")
+
+
+def _ensure_index_tfidf() -> Tuple[TfidfTransformer, Any, _MetaTable]:
+    """
+    Lazy bygging av TF‑IDF indeks ved første kall. Returnerer
+    (idf-transformer, matrise, meta) slik at kallere slipper nye globale oppslag.
+    """
+    global _TF, _MTX, _MTX_T, _META, _INDEX_EPOCH
+    if _TF is not None and _MTX is not None and _MTX_T is not None:
+        return _TF, _MTX, _META
+    _transform_query.cache_clear()
+    _INDEX_EPOCH += 1
+    # Uendret kunnskapsbase: last ferdig indeks fra disk i stedet for å lese og tilpasse på nytt
+    sig = _corpus_signature()
+    cached = _load_tfidf_cache(sig)
+    if cached is not None:
+        _TF, _MTX, _META = cached
+    else:
+        _TF, _MTX, _META = _fit_tfidf(sig)
+    # Transponert (termer × biter) som CSR: et spørringsprodukt leser da kun
+    # radene for spørringens termer i stedet for å gå gjennom hele matrisen
+    _MTX_T = _MTX.T.tocsr()
+    return _TF, _MTX, _META
+
+
+def _fit_tfidf(sig: str) -> Tuple[TfidfTransformer, Any, _MetaTable]:
+    """
+    Tilpass TF‑IDF og lagre resultatet i disk-cachen. Kun filer som er nye
+    eller endret siden forrige bygging (sti, mtime, størrelse) leses og
+    vektoriseres; radene for uendrede filer gjenbrukes fra den rå
+    tellematrisen (HashingVectorizer har ikke noe vokabular som må tilpasses).
+    Idf beregnes alltid på nytt over hele korpuset.
+    """
+    from scipy import sparse
+    from sklearn.feature_extraction.text import TfidfTransformer
+
+    hv = _hashing_vectorizer()
+    prev = _load_file_cache()
+    files = []
+    for p in _iter_kb_files():
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        files.append((p, st.st_mtime_ns, st.st_size))
+    todo = [p for p, mtime_ns, size in files if prev.get(p.as_posix(), (None, None))[:2] != (mtime_ns, size)]
+    fresh = dict(zip(todo, _load_files(todo)))
+
+    blocks = []
+    chunks: List[Dict] = []
+    manifest = []
+    for p, mtime_ns, size in files:
+        if p in fresh:
+            docs = fresh[p]
+            if docs:
+                block = hv.transform([d["text"] for d in docs])
+            else:
+                block = sparse.csr_matrix((0, hv.n_features), dtype=np.float32)
+        else:
+            _, _, block, docs = prev[p.as_posix()]
+        manifest.append((p.as_posix(), mtime_ns, size, len(chunks), len(chunks) + len(docs)))
+        blocks.append(block)
+        chunks.extend(docs)
+    all_counts = (
+        sparse.vstack(blocks, format="csr", dtype=np.float32)
+        if blocks
+        else sparse.csr_matrix((0, hv.n_features), dtype=np.float32)
     )
-    _MTX = _VEC.fit_transform(texts)
+    _save_file_cache(manifest, all_counts, chunks)
 
+    corpus, keep = _dedupe_chunks(chunks)
+    meta = _MetaTable(corpus)
+    # ingen dokumenter; tilpass på en tom tekst for å unngå crash
+    counts = all_counts[keep] if corpus else hv.transform([""]).tocsr()
+    tf = TfidfTransformer(**_TFIDF_PARAMS).fit(counts)
+    # Termer som ikke finnes i korpuset får idf 0, slik at de (som med et
+    # vokabular) ikke tar plass i normen til spørringsvektoren
+    idf = tf.idf_.astype(np.float32)
+    idf[np.bincount(counts.indices, minlength=idf.size) == 0] = 0.0
+    tf.idf_ = idf
+    mtx = tf.transform(counts).tocsr()
+    if corpus:
+        _save_tfidf_cache(sig, tf, mtx, corpus)
+    return tf, mtx, meta
 
-def _ensure_index_openai() -> None:
-    """Lazy last OpenAI-indeks fra disk og håndter pickled arrays."""
-    global _EMB, _META_OAI
-    if _EMB is not None and _META_OAI:
-        return
-    vec_path = DATA_DIR / "vectors.npy"
-    meta_path = DATA_DIR / "meta.jsonl"
-    if not vec_path.exists() or not meta_path.exists():
-        raise FileNotFoundError(
-            "OpenAI-indeks mangler. Kjør ingestion med USE_OPENAI=1 for å generere embeddings."
-        )
-    # Last vektorfil med allow_pickle og håndter objekt-array
+
+def _load_faiss(n_rows: int, sig: str):
+    """
+    Last `index.faiss` skrevet av ingest, dersom faiss er installert og
+    signaturen i `index.sig` stemmer med meta (`sig`, se `index_signature`).
+    Ellers returneres None.
+    """
+    path = DATA_DIR / "index.faiss"
+    if faiss is None or not path.exists():
+        return None
+    try:
+        # Utdatert indeks (f.eks. fra en tidligere eller avbrutt bygging) brukes
+        # ikke, selv om antallet rader tilfeldigvis stemmer
+        if (DATA_DIR / "index.sig").read_text(encoding="utf-8").strip() != sig:
+            return None
+        index = _read_faiss(path)
+    except Exception:
+        return None
+    return index if index.ntotal == n_rows else None
+
+
+def _read_faiss(path: Path):
+    """
+    Les indeksen med kodene memory-mappet (`IO_FLAG_MMAP_IFC`) der faiss
+    støtter det, så flere prosesser deler de samme sidene som `vectors.npy`.
+    Eldre faiss uten flagget leser hele filen inn i minnet.
+    """
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if flag is not None:
+        try:
+            return faiss.read_index(str(path), flag)
+        except Exception:
+            pass
+    return faiss.read_index(str(path))
+
+
+def _faiss_search(index, Q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    `index.search` for en batch spørringer. HNSW søkes med `efSearch` på minst
+    `max(64, 4k)` (FAISS-standarden 16 gir merkbart lavere recall enn flat
+    indeks); parameteren sendes per kall, så den delte indeksen ikke endres.
+    """
+    if hasattr(index, "hnsw"):
+        params = faiss.SearchParametersHNSW(efSearch=max(_HNSW_EF_SEARCH, 4 * k))
+        return index.search(Q, k, params=params)
+    return index.search(Q, k)
+
+
+def _npy_dtype(path: Path) -> Optional[np.dtype]:
+    """Les dtype fra `.npy`-headeren uten å laste data; None hvis headeren ikke kan leses."""
+    try:
+        with path.open("rb") as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                _, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                _, _, dtype = np.lib.format.read_array_header_2_0(f)
+        return dtype
+    except Exception:
+        return None
+
+
+def _load_legacy_vectors(vec_path: Path) -> np.ndarray:
+    """
+    Last en eldre vektorfil lagret som objekt-array (krever pickle), og
+    skriv den om til en sammenhengende float32-fil slik at neste oppstart
+    kan memory-mappe den. Omskrivingen er best effort.
+    """
     try:
         arr = np.load(vec_path, allow_pickle=True)
     except Exception as e:
@@ -273,58 +689,358 @@ def _ensure_index_openai() -> None:
                 f"Vektorfil '{vec_path}' inneholder uventet format: {e}. "
                 "Bygg indeksen på nytt med ingest.py."
             )
+        tmp = vec_path.with_name(vec_path.name + ".tmp")
+        try:
+            with tmp.open("wb") as f:
+                np.save(f, np.ascontiguousarray(arr, dtype=np.float32), allow_pickle=False)
+            os.replace(tmp, vec_path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+    return arr
+
+
+def _rows_unit_norm(arr: np.ndarray, sample: int = 1024) -> bool:
+    """Sjekk (på et utvalg rader) om matrisen allerede er L2-normalisert."""
+    head = np.asarray(arr[:sample], dtype=np.float32)
+    return bool(np.allclose(np.linalg.norm(head, axis=1), 1.0, atol=1e-2))
+
+
+def _normalized_rows(arr: np.ndarray, cache_path: Path) -> np.ndarray:
+    """
+    L2-normaliser radene til en sammenhengende (C-ordnet) matrise og lagre
+    den som `cache_path` (via midlertidig fil + os.replace), slik at neste
+    oppstart kan memory-mappe den direkte. Lagringen er best effort.
+    """
+    X = np.asarray(arr, dtype=np.float32)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    out = np.ascontiguousarray(X / np.maximum(norms, 1e-12), dtype=arr.dtype)
+    tmp = cache_path.with_name(cache_path.stem + ".tmp.npy")
+    try:
+        np.save(tmp, out, allow_pickle=False)
+        os.replace(tmp, cache_path)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+    return out
+
+
+def _ensure_index_openai() -> Tuple[np.ndarray, _MetaTable, Any]:
+    """
+    Lazy last OpenAI-indeks fra disk (memory-mappet; eldre pickled arrays
+    lastes inn i minnet). Returnerer (embeddings, meta, faiss-indeks eller None).
+    """
+    global _EMB, _META_OAI, _FAISS, _INDEX_EPOCH
+    if _EMB is not None:
+        return _EMB, _META_OAI, _FAISS
+    _INDEX_EPOCH += 1
+    vec_path = DATA_DIR / "vectors.npy"
+    meta_path = DATA_DIR / "meta.jsonl"
+    if not vec_path.exists() or not meta_path.exists():
+        raise FileNotFoundError(
+            "OpenAI-indeks mangler. Kjør ingestion med USE_OPENAI=1 for å generere embeddings."
+        )
+    # Normalisert kopi fra en tidligere oppstart brukes så lenge den er nyere enn kilden
+    norm_path = vec_path.with_name(vec_path.stem + "_norm.npy")
+    if norm_path.exists() and norm_path.stat().st_mtime_ns >= vec_path.stat().st_mtime_ns:
+        vec_path = norm_path
+    # Memory-map vektorfilen (read-only, delt page cache mellom prosesser).
+    # Ingest bytter inn nye filer med os.replace, så en åpen mapping forblir gyldig.
+    # Headeren avgjør formatet: eldre objekt-arrays (pickle) kan ikke memory-mappes
+    dtype = _npy_dtype(vec_path)
+    if dtype is not None and dtype.hasobject:
+        arr = _load_legacy_vectors(vec_path)
     else:
+        try:
+            arr = np.load(vec_path, mmap_mode="r", allow_pickle=False)
+        except Exception as e:
+            raise RuntimeError(f"Kunne ikke laste vektorfil '{vec_path}': {e}")
+    if arr.dtype not in (np.float16, np.float32):
         arr = arr.astype("float32")
+    # Ingest lagrer radene L2-normalisert; normaliser kun hvis filen ikke er
+    # det (én gang, lagret til disk), så hvert søk er ett rent matrise-vektor-produkt
+    if arr.size > 0 and not _rows_unit_norm(arr):
+        arr = _normalized_rows(arr, norm_path)
     _EMB = arr
-    _META_OAI = []
-    with meta_path.open("r", encoding="utf-8") as f:
-        for line in f:
-            _META_OAI.append(json.loads(line))
+    rows = read_jsonl(meta_path)
+    _META_OAI = _MetaTable(rows)
+    # Mangler index.faiss (eller er den utdatert) søkes det med NumPy over de
+    # memory-mappede vektorene; indeksen bygges kun av ingest, ikke per prosess
+    _FAISS = _load_faiss(len(rows), index_signature(rows))
+    return _EMB, _META_OAI, _FAISS
+
+
+@lru_cache(maxsize=512)
+def _transform_query(query: str):
+    """
+    TF‑IDF-vektor for en spørring, memoisert siden samme spørsmål ofte
+    stilles på nytt i chat-UI. Tømmes når vectorizeren bygges på nytt.
+    """
+    return _TF.transform(_hashing_vectorizer().transform([query]))  # type: ignore
+
+
+def clear_query_cache() -> None:
+    """Tøm memoiserte spørringsvektorer og søkeresultater (kall etter at indeksen er bygget på nytt)."""
+    _transform_query.cache_clear()
+    with _QUERY_CACHE_LOCK:
+        _QUERY_CACHE.clear()
+
+
+def _top_k(sims: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indekser for de k høyeste scorene, sortert synkende. Bruker
+    `argpartition` (O(N)) og sorterer kun de k vinnerne.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= sims.size:
+        return np.argsort(-sims)
+    idx = np.argpartition(sims, -k)[-k:]
+    return idx[np.argsort(-sims[idx])]
+
+
+def _to_hits(order: np.ndarray, scores: np.ndarray, meta: _MetaTable) -> List[Dict]:
+    """Bygg treff-dicts (meta + score) for de valgte radene; `scores` følger `order`."""
+    out = meta.rows(order)
+    for m, score in zip(out, np.asarray(scores, dtype=np.float64).tolist()):
+        m["score"] = score
+    return out
 
 
 # ---------- Public API ----------
 
 
-def search(query: str, k: int = 6) -> List[Dict]:
+def _qemb_db() -> Optional[sqlite3.Connection]:
     """
-    Søk etter de k mest relevante dokumentbitene.
+    Åpne (lazy) SQLite-cachen for spørrings-embeddings i `DATA_DIR`.
+    Returnerer None hvis databasen ikke kan åpnes (f.eks. skrivebeskyttet disk).
+    """
+    global _QEMB_DB
+    if _QEMB_DB is None:
+        try:
+            DATA_DIR.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(DATA_DIR / "qemb_cache.sqlite"), check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS emb (h BLOB PRIMARY KEY, model TEXT, vec BLOB)")
+            _QEMB_DB = db
+        except Exception:
+            return None
+    return _QEMB_DB
 
-    Returnerer en liste med dicts med felter: text, source, title, score,
-    doc_type, version_date, page, chunk_idx og id.
+
+def _qemb_key(query: str) -> bytes:
+    return hashlib.sha1(f"{_embed_model()}\0{query}".encode("utf-8")).digest()
+
+
+def _qemb_get(query: str) -> Optional[np.ndarray]:
+    """Embedding for `query` fra disk-cachen, eller None."""
+    db = _qemb_db()
+    if db is None:
+        return None
+    try:
+        with _QEMB_LOCK:
+            row = db.execute("SELECT vec FROM emb WHERE h = ?", (_qemb_key(query),)).fetchone()
+    except Exception:
+        return None
+    return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+
+def _qemb_put(pairs: Iterable[Tuple[str, np.ndarray]]) -> None:
+    """Lagre (spørring, embedding)-par i disk-cachen. Feil ignoreres."""
+    db = _qemb_db()
+    if db is None:
+        return
+    model = _embed_model()
+    rows = [(_qemb_key(q), model, np.asarray(v, dtype=np.float32).tobytes()) for q, v in pairs]
+    try:
+        with _QEMB_LOCK, db:
+            db.executemany("INSERT OR REPLACE INTO emb (h, model, vec) VALUES (?, ?, ?)", rows)
+    except Exception:
+        pass
+
+
+def _embed_query(query: str) -> Optional[np.ndarray]:
+    """
+    Normalisert OpenAI-embedding for en spørring, eller None hvis kallet feiler.
+    Embeddings caches i SQLite på disk, så gjentatte spørringer (også etter
+    omstart) ikke går til API-et.
     """
-    if USE_OPENAI and _openai is not None:
-        _ensure_index_openai()
-        # Embedd spørringen med OpenAI embeddings
+    qvec = _qemb_get(query)
+    if qvec is None:
         try:
-            r = _openai.embeddings.create(model=EMBED_MODEL, input=query)
+            r = _openai.embeddings.create(model=_embed_model(), input=query)  # type: ignore
         except Exception:
-            # Faller tilbake til TF‑IDF hvis embed feiler
-            return search_tfidf(query, k)
+            return None
         qvec = np.array(r.data[0].embedding, dtype="float32")
-        qvec = qvec / (np.linalg.norm(qvec) + 1e-12)
-        sims = _EMB @ qvec  # type: ignore
-        order = np.argsort(-sims)[:k]
-        out: List[Dict] = []
-        for idx in order:
-            m = dict(_META_OAI[idx])
-            m["score"] = float(sims[idx])
-            out.append(m)
-        return out
-    # TF‑IDF
-    return search_tfidf(query, k)
+        _qemb_put([(query, qvec)])
+    return qvec / (np.linalg.norm(qvec) + 1e-12)
+
+
+def _embed_queries(queries: List[str]) -> Optional[np.ndarray]:
+    """
+    Normaliserte embeddings (én rad per spørring) for flere spørringer. Det
+    som ikke ligger i disk-cachen hentes med ett batch-kall til OpenAI.
+    Returnerer None hvis kallet feiler.
+    """
+    vecs = [_qemb_get(q) for q in queries]
+    missing = list(dict.fromkeys(q for q, v in zip(queries, vecs) if v is None))
+    if missing:
+        try:
+            r = _openai.embeddings.create(model=_embed_model(), input=missing)  # type: ignore
+        except Exception:
+            return None
+        fresh = {q: np.asarray(d.embedding, dtype=np.float32) for q, d in zip(missing, r.data)}
+        _qemb_put(fresh.items())
+        vecs = [fresh[q] if v is None else v for q, v in zip(queries, vecs)]
+    Q = np.vstack(vecs).astype(np.float32, copy=False)
+    return Q / (np.linalg.norm(Q, axis=1, keepdims=True) + 1e-12)
+
+
+def warmup(queries: Iterable[str]) -> int:
+    """
+    Forhåndsfyll embedding-cachen for vanlige spørringer med ett batch-kall
+    til OpenAI. Returnerer antall nye embeddings (0 i TF‑IDF-modus).
+    """
+    if not _use_openai():
+        return 0
+    missing = list(dict.fromkeys(q for q in queries if _qemb_get(q) is None))
+    if not missing:
+        return 0
+    r = _openai.embeddings.create(model=_embed_model(), input=missing)
+    _qemb_put((q, np.asarray(d.embedding, dtype=np.float32)) for q, d in zip(missing, r.data))
+    return len(missing)
+
+
+def _search_openai(query: str, k: int) -> Optional[List[Dict]]:
+    """OpenAI-søk; None hvis spørringen ikke kunne embeddes."""
+    emb, meta, index = _ensure_index_openai()
+    qvec = _embed_query(query)
+    if qvec is None:
+        return None
+    if index is not None:
+        # FAISS: SIMD/flertrådet indre produkt (eller HNSW) med top-k internt
+        kk = min(k, index.ntotal)
+        if kk <= 0:
+            return []
+        scores, order = _faiss_search(index, qvec[None, :], kk)
+        keep = order[0] >= 0  # HNSW kan fylle opp med -1
+        return _to_hits(order[0][keep], scores[0][keep], meta)
+    sims = cosine_scores(qvec, emb)
+    order = _top_k(sims, k)
+    return _to_hits(order, sims[order], meta)
+
+
+def _search_openai_many(queries: List[str], k: int) -> Optional[List[List[Dict]]]:
+    """
+    OpenAI-søk for flere spørringer: ett embeddings-kall for hele batchen og
+    ett matrise-matrise-produkt (eller ett FAISS-søk). None hvis embed feiler.
+    """
+    emb, meta, index = _ensure_index_openai()
+    Q = _embed_queries(queries)
+    if Q is None:
+        return None
+    if index is not None:
+        kk = min(k, index.ntotal)
+        if kk <= 0:
+            return [[] for _ in queries]
+        scores, order = _faiss_search(index, Q, kk)
+        return [_to_hits(o[o >= 0], s[o >= 0], meta) for s, o in zip(scores, order)]
+    if emb.dtype == np.float32:
+        S = Q @ emb.T  # (antall spørringer, antall biter), én GEMM
+    else:
+        S = np.stack([cosine_scores(q, emb) for q in Q])
+    out: List[List[Dict]] = []
+    for row in S:
+        order = _top_k(row, k)
+        out.append(_to_hits(order, row[order], meta))
+    return out
+
+
+def _copy_hit(m: Dict) -> Dict:
+    """Kopi av et treff for spørringscachen; `aliases`-listen kopieres også, så den ikke deles."""
+    out = dict(m)
+    if "aliases" in out:
+        out["aliases"] = list(out["aliases"])
+    return out
+
+
+def _cache_key(query: str, k: int) -> tuple:
+    """Nøkkel i spørringscachen; epoken gjør treff fra en eldre indeks ugyldige."""
+    return (query.strip().lower(), k, _use_openai(), _INDEX_EPOCH)
+
+
+def search(query: str, k: int = 6) -> List[Dict]:
+    """
+    Søk etter de k mest relevante dokumentbitene.
+
+    Returnerer en liste med dicts med felter: text, source, title, score,
+    doc_type, version_date, page, chunk_idx og id. Resultater for gjentatte
+    spørringer hentes fra en LRU-cache (kopier, så cachen ikke kan endres).
+    """
+    with _QUERY_CACHE_LOCK:
+        key = _cache_key(query, k)
+        cached = _QUERY_CACHE.get(key)
+        if cached is not None:
+            _QUERY_CACHE.move_to_end(key)
+    if cached is not None:
+        return [_copy_hit(m) for m in cached]
+
+    hits = None
+    use_openai = _use_openai()
+    if use_openai:
+        hits = _search_openai(query, k)
+    if hits is None:
+        # TF‑IDF, også som fallback hvis embed feiler (caches ikke, prøv OpenAI igjen neste gang)
+        hits = search_tfidf(query, k)
+        if use_openai:
+            return hits
+    with _QUERY_CACHE_LOCK:
+        # Nøkkelen beregnes etter søket: første kall kan ha lastet indeksen (ny epoke)
+        _QUERY_CACHE[_cache_key(query, k)] = [_copy_hit(m) for m in hits]
+        while len(_QUERY_CACHE) > _CACHE_MAX:
+            _QUERY_CACHE.popitem(last=False)
+    return hits
+
+
+def search_many(queries: List[str], k: int = 6) -> List[List[Dict]]:
+    """
+    Søk for flere spørringer samtidig (evaluering, avspilling av historikk).
+    Returnerer én trefliste per spørring, i samme rekkefølge som `queries`.
+    I OpenAI-modus embeddes alle spørringene i ett kall; feiler det, brukes
+    TF‑IDF for hele batchen.
+    """
+    if not queries:
+        return []
+    if _use_openai():
+        hits = _search_openai_many(queries, k)
+        if hits is not None:
+            return hits
+    return search_tfidf_many(queries, k)
+
+
+def search_tfidf_many(queries: List[str], k: int = 6) -> List[List[Dict]]:
+    """
+    TF‑IDF-søk for en liste spørringer: én `transform` og ett sparse
+    matriseprodukt for hele batchen i stedet for ett per spørring.
+    """
+    tf, _, meta = _ensure_index_tfidf()
+    if not meta or not queries:
+        return [[] for _ in queries]
+    Q = tf.transform(_hashing_vectorizer().transform(queries))
+    S = (Q @ _MTX_T).toarray()  # (antall spørringer, antall biter)
+    out: List[List[Dict]] = []
+    for row in S:
+        order = _top_k(row, k)
+        out.append(_to_hits(order, row[order], meta))
+    return out
 
 
 def search_tfidf(query: str, k: int = 6) -> List[Dict]:
     """Indre funksjon for TF‑IDF-søk, tilgjengelig for fallback."""
-    _ensure_index_tfidf()
-    if _VEC is None or _MTX is None:
+    _, _, meta = _ensure_index_tfidf()
+    if not meta:
+        # Tomt korpus – matrisen har kun en plassholder-rad
         return []
-    qvec = _VEC.transform([query])  # type: ignore
-    sims = linear_kernel(qvec, _MTX).ravel()  # type: ignore
-    order = np.argsort(-sims)[:k]
-    out: List[Dict] = []
-    for idx in order:
-        m = dict(_META[idx])
-        m["score"] = float(sims[idx])
-        out.append(m)
-    return out
+    qvec = _transform_query(query)
+    # Rader og spørring er L2-normalisert, så cosinus er et rent sparse matriseprodukt
+    # som kun berører spørringens termer (rader i den transponerte matrisen)
+    sims = (qvec @ _MTX_T).toarray().ravel()
+    order = _top_k(sims, k)
+    return _to_hits(order, sims[order], meta)
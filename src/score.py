@@ -0,0 +1,31 @@
+"""
+Likhetsberegning for tette embeddings i Asker Fotball.
+
+Embeddings lagres L2-normalisert, så cosinus-likhet er et rent
+indre produkt. Dersom `simsimd` er installert brukes dens SIMD-kjerner
+(AVX2/AVX-512/NEON, også for float16); ellers brukes NumPy/BLAS.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+
+try:
+    import simsimd  # type: ignore
+except Exception:
+    simsimd = None  # type: ignore
+
+
+def cosine_scores(query: np.ndarray, X: np.ndarray) -> np.ndarray:
+    """
+    Returner cosinus-likhet (float32, shape (n,)) mellom en normalisert
+    spørringsvektor og hver rad i den normaliserte matrisen `X`.
+    """
+    q = np.ascontiguousarray(query, dtype=X.dtype)
+    if simsimd is not None and X.size > 0:
+        try:
+            dist = simsimd.cdist(q[None, :], X, metric="cos")
+            return 1.0 - np.asarray(dist, dtype=np.float32).ravel()
+        except Exception:
+            pass
+    return np.asarray(X @ q, dtype=np.float32).ravel()
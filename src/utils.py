@@ -6,21 +6,145 @@ Inneholder funksjoner for å lese markdown‑filer og dele tekst i enkle biter.
 
 from __future__ import annotations
 
+import hashlib
+import json
 import os
+import re
 from pathlib import Path
-from typing import Dict, List, TYPE_CHECKING
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, TYPE_CHECKING
 from datetime import datetime
 
+try:
+    import orjson  # type: ignore
+except Exception:
+    orjson = None  # type: ignore
+
+try:
+    import ahocorasick  # type: ignore  # pyahocorasick
+except Exception:
+    ahocorasick = None  # type: ignore
+
 if TYPE_CHECKING:  # pragma: no cover - kun for typehinting
     from huggingface_hub import HfApi
 
 
-def _read_text_file(p: Path) -> str:
-    """Try å lese en fil med UTF‑8, fall tilbake til latin‑1 om nødvendig."""
+def _read_text_file(p: Path, max_chars: Optional[int] = None) -> str:
+    """
+    Les tekstfil med UTF‑8. Ugyldige bytes erstattes med U+FFFD, så en ellers
+    gyldig fil med én feil byte ikke blir dekodet som noe annet tegnsett.
+    Med `max_chars` leses kun de første `max_chars` tegnene, så en enkelt
+    stor fil ikke fyller minnet.
+    """
     try:
-        return p.read_text(encoding="utf-8")
-    except Exception:
-        return p.read_text(encoding="latin-1", errors="ignore")
+        with p.open(encoding="utf-8", errors="replace") as f:
+            return f.read(-1 if max_chars is None else max_chars)
+    except OSError:
+        return ""
+
+
+def iter_files(root: Path) -> Iterator[os.DirEntry]:
+    """
+    Gå rekursivt gjennom `root` med `os.scandir` og gi alle filer, i samme
+    rekkefølge som `Path.rglob` (filene i en katalog før underkatalogene).
+
+    Bruker en eksplisitt stakk; `DirEntry` gjenbruker filtypen fra
+    katalogoppslaget, så det blir ingen ekstra `stat` per fil. Symlenkede
+    kataloger følges ikke (som `rglob`), og kataloger som ikke kan leses
+    hoppes over.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+        # Baklengs på stakken, så underkatalogene besøkes i scandir-rekkefølge
+        stack.extend(reversed(subdirs))
+
+
+def compile_triggers(groups: Mapping[str, Iterable[str]]) -> Tuple[Any, Dict[str, FrozenSet[str]]]:
+    """
+    Kompiler alle triggere i `groups` til én matcher som finner treff i ett pass.
+
+    Med `pyahocorasick` installert bygges en Aho–Corasick-automat (ett lineært
+    pass, alle overlappende treff). Ellers brukes én regex med lookahead slik
+    at treff kan overlappe, som gir lengste trigger per posisjon. Hver trigger
+    mappes til alle gruppene som har en trigger som er delstreng av den, så
+    resultatet blir det samme som å sjekke `any(t in tekst for t in triggere)`
+    for hver gruppe.
+    """
+    groups = {g: tuple(triggers) for g, triggers in groups.items()}
+    words = {t for triggers in groups.values() for t in triggers}
+    labels = {
+        w: frozenset(g for g, triggers in groups.items() if any(t in w for t in triggers))
+        for w in words
+    }
+    if ahocorasick is not None and words:
+        automaton = ahocorasick.Automaton()
+        for w in words:
+            automaton.add_word(w, labels[w])
+        automaton.make_automaton()
+        return automaton, labels
+    alternation = "|".join(map(re.escape, sorted(words, key=len, reverse=True)))
+    return re.compile(f"(?=({alternation}))"), labels
+
+
+def match_groups(text: str, matcher: Any, labels: Dict[str, FrozenSet[str]]) -> Set[str]:
+    """Returner navnene på alle grupper som har minst én trigger i `text` (se `compile_triggers`)."""
+    found: Set[str] = set()
+    if isinstance(matcher, re.Pattern):
+        for m in matcher.finditer(text):
+            found |= labels[m.group(1)]
+    else:
+        for _, groups in matcher.iter(text):
+            found |= groups
+    return found
+
+
+def iter_jsonl(path: Path, skip_invalid: bool = False) -> Iterator[Dict]:
+    """
+    Strøm en JSONL-fil linje for linje (konstant minnebruk) og parse hver
+    linje med orjson hvis installert (ellers `json`), direkte fra bytes.
+    Tomme linjer hoppes over; ugyldige linjer hoppes over hvis `skip_invalid`.
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    with Path(path).open("rb") as f:
+        for raw in f:
+            raw = raw.strip()
+            if not raw:
+                continue
+            try:
+                yield loads(raw)
+            except ValueError:  # JSONDecodeError (begge parsere) og UnicodeDecodeError
+                if not skip_invalid:
+                    raise
+
+
+def read_jsonl(path: Path) -> List[Dict]:
+    """Les en hel JSONL-fil (f.eks. `meta.jsonl`) til en liste, se `iter_jsonl`."""
+    return list(iter_jsonl(path))
+
+
+def index_signature(rows: Iterable[Mapping[str, Any]]) -> str:
+    """
+    Signatur for radene i en vektorindeks: `id` og innholds-`hash` per rad, i
+    rekkefølge. Ingest lagrer den ved siden av `index.faiss`, og retrieve
+    bruker indeksen kun når signaturen stemmer med `meta.jsonl`.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for r in rows:
+        h.update(f"{r.get('id', '')}\t{r.get('hash', '')}\n".encode("utf-8"))
+    return h.hexdigest()
 
 
 def read_markdown_files(kb_dir: str) -> List[Dict]:
@@ -32,14 +156,13 @@ def read_markdown_files(kb_dir: str) -> List[Dict]:
     if not root.exists():
         return []
     out: List[Dict] = []
-    for p in root.rglob("*"):
-        if not p.is_file():
-            continue
+    for entry in iter_files(root):
+        p = Path(entry.path)
         if p.suffix.lower() not in {".md", ".txt"}:
             continue
         text = _read_text_file(p)
         title = p.stem.replace("_", " ").strip() or "Uten tittel"
-        version_date = datetime.fromtimestamp(p.stat().st_mtime).date().isoformat()
+        version_date = datetime.fromtimestamp(entry.stat().st_mtime).date().isoformat()
         out.append({"title": title, "source": str(p), "text": text, "version_date": version_date})
     return out
 
@@ -63,6 +186,10 @@ def simple_chunks(text: str, size: int = 800, overlap: int = 120) -> List[str]:
     return out
 
 
+# Verdier som tolkes som sann i env_flag
+_TRUE_VALUES = frozenset({"1", "true", "yes", "on"})
+
+
 def env_flag(name: str, default: bool = False) -> bool:
     """Les boolsk miljøvariabel case-insensitive og uten understrek.
 
@@ -83,9 +210,10 @@ def env_flag(name: str, default: bool = False) -> bool:
     for key in variants:
         v = os.getenv(key)
         if v is not None:
-            return v.strip().lower() in {"1", "true", "yes", "on"}
+            return v.strip().lower() in _TRUE_VALUES
     return default
 
+
 def get_hf_api() -> "HfApi":
     """Autentiser og returner en ``HfApi``-klient."""
     token = os.getenv("HUGGINGFACEHUB_API_TOKEN")
@@ -0,0 +1,46 @@
+import asyncio
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import src.answer as answer_mod
+from src.answer import answer, answer_async, answer_batch
+
+
+def test_answer_batch_matches_answer(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    queries = ["hva koster sesongkort", "hvor parkerer jeg på kampdag", "kontakt telefon"]
+    for q, (text, hits) in zip(queries, answer_batch(queries)):
+        single_text, single_hits = answer(q)
+        assert text == single_text
+        assert [h["id"] for h in hits] == [h["id"] for h in single_hits]
+    assert answer_batch([]) == []
+
+
+def test_answer_async_matches_answer(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    q = "hva koster sesongkort"
+    text, hits = asyncio.run(answer_async(q))
+    single_text, single_hits = answer(q)
+    assert text == single_text
+    assert [h["id"] for h in hits] == [h["id"] for h in single_hits]
+
+
+def test_llm_async_fallback_keeps_prefix(monkeypatch):
+    from types import SimpleNamespace
+
+    sent = []
+
+    def create(model, messages, **kwargs):
+        sent.append(messages)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Svar her"))])
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(answer_mod, "_openai", client)
+    monkeypatch.setattr(answer_mod, "_openai_async", None)
+    prefix = [{"role": "system", "content": "prefiks"}]
+    out = asyncio.run(answer_mod._llm_async("spørsmål", [{"text": "utdrag"}], prefix))
+    assert out == "Svar her"
+    assert sent[0][0] == prefix[0] and sent[0][-1]["role"] == "user"
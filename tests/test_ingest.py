@@ -0,0 +1,162 @@
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import src.ingest as ingest
+
+
+class _RateLimited(Exception):
+    status_code = 429
+    response = SimpleNamespace(headers={"retry-after": "0"})
+
+
+def _fake_client(fail_on_call: int = -1):
+    calls = {"n": 0}
+
+    def create(model, input):
+        calls["n"] += 1
+        if calls["n"] == fail_on_call:
+            raise _RateLimited()
+        return SimpleNamespace(
+            data=[SimpleNamespace(embedding=[float(len(t)), 1.0]) for t in input]
+        )
+
+    return SimpleNamespace(embeddings=SimpleNamespace(create=create))
+
+
+def test_openai_embeddings_keep_order_and_retry(monkeypatch):
+    monkeypatch.setattr(ingest, "client", _fake_client(fail_on_call=2))
+    monkeypatch.setattr(ingest, "OPENAI_API_KEY", "test")
+    chunks = [{"text": "x" * n} for n in range(1, 11)]
+    X = ingest._build_openai_embeddings(chunks, batch_size=3)
+    assert X.shape == (10, 2) and X.dtype == np.float32
+    assert np.allclose(np.linalg.norm(X, axis=1), 1.0)
+    assert np.allclose(X[:, 0] / X[:, 1], np.arange(1, 11), rtol=1e-5)
+
+
+def test_pack_batches_respects_input_and_token_limits():
+    batches = list(ingest._pack_batches(["x" * 400] * 10, max_inputs=4, max_tokens=250))
+    assert [len(b) for b in batches] == [2, 2, 2, 2, 2]
+    batches = list(ingest._pack_batches(["kort"] * 10, max_inputs=4))
+    assert [len(b) for b in batches] == [4, 4, 2]
+
+
+def test_incremental_embeddings_only_embed_changed_chunks(monkeypatch, tmp_path):
+    sent = []
+
+    def create(model, input):
+        sent.extend(input)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(t)), 1.0]) for t in input])
+
+    monkeypatch.setattr(ingest, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(ingest, "OPENAI_API_KEY", "test")
+    monkeypatch.setattr(ingest, "DATA_DIR", tmp_path)
+
+    def chunks(texts):
+        return [{"id": f"a.md#{i}", "text": t, "hash": ingest._chunk_hash(t)} for i, t in enumerate(texts)]
+
+    first = chunks(["a", "bb", "ccc"])
+    X = ingest._embed_incremental(first)
+    np.save(tmp_path / "vectors.npy", X)
+    ingest._save_meta(first)
+
+    sent.clear()
+    Y = ingest._embed_incremental(chunks(["a", "dddd", "ccc"]))
+    assert sent == ["dddd"]
+    assert np.allclose(Y[[0, 2]], X[[0, 2]])
+    assert np.allclose(Y[1, 0] / Y[1, 1], 4.0)
+
+    sent.clear()
+    ingest._embed_incremental(chunks(["a", "dddd", "ccc"]), force=True)
+    assert sent == ["a", "dddd", "ccc"]
+
+    # Uendret korpus uten nøkkel eller klient: alt gjenbrukes uten API-kall
+    second = chunks(["a", "dddd", "ccc"])
+    np.save(tmp_path / "vectors.npy", ingest._embed_incremental(second))
+    ingest._save_meta(second)
+    monkeypatch.setattr(ingest, "client", None)
+    monkeypatch.setattr(ingest, "OPENAI_API_KEY", None)
+    assert np.allclose(ingest._embed_incremental(chunks(["a", "dddd", "ccc"])), Y)
+
+
+def test_duplicate_texts_are_embedded_once(monkeypatch):
+    sent = []
+
+    def create(model, input):
+        sent.extend(input)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(t)), 1.0]) for t in input])
+
+    monkeypatch.setattr(ingest, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(ingest, "OPENAI_API_KEY", "test")
+    chunks = [{"text": t} for t in ["aa", "b", "aa", "ccc", "b"]]
+    X = ingest._build_openai_embeddings(chunks, batch_size=2)
+    assert sorted(sent) == ["aa", "b", "ccc"]
+    assert np.allclose(X[:, 0] / X[:, 1], [2, 1, 2, 3, 1])
+
+
+def test_tfidf_rows_are_unit_norm_and_duplicates_share_values(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest, "DATA_DIR", tmp_path)
+    texts = ["Sesongkort på Føyka", "Parkering på kampdag", "Sesongkort på Føyka"]
+    mtx = ingest._build_tfidf_sparse([{"text": t} for t in texts])
+    assert mtx.shape[0] == 3
+    assert np.allclose(np.sqrt(mtx.multiply(mtx).sum(axis=1)), 1.0)
+    assert abs(mtx[0] - mtx[2]).max() == 0
+
+
+def test_failed_batch_cancels_pending_batches(monkeypatch, tmp_path):
+    import pytest
+
+    calls = []
+
+    def create(model, input):
+        calls.append(input)
+        time.sleep(0.01)  # la hovedtråden se feilen før køen er tømt
+        if len(calls) == 2:
+            raise ValueError("nede")
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0]) for _ in input])
+
+    monkeypatch.setattr(ingest, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(ingest, "OPENAI_API_KEY", "test")
+    out_path = tmp_path / "vectors.tmp.npy"
+    chunks = [{"text": f"tekst {i}"} for i in range(20)]
+    with pytest.raises(RuntimeError):
+        ingest._build_openai_embeddings(chunks, batch_size=1, max_in_flight=1, out_path=out_path)
+    assert len(calls) < 20
+    assert not out_path.exists()
+
+
+def test_markdown_is_truncated_only_past_the_cap(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(ingest, "MAX_MD_CHARS", 10)
+    exact, longer = tmp_path / "exact.md", tmp_path / "longer.md"
+    exact.write_text("a" * 10, encoding="utf-8")
+    longer.write_text("b" * 11, encoding="utf-8")
+    paths = [exact, longer]
+    docs = list(ingest._docs_from_files(paths, map(ingest._read_kb_file, paths)))
+    assert [d["text"] for d in docs] == ["a" * 10, "b" * 10]
+    out = capsys.readouterr().out
+    assert "longer.md" in out and "exact.md" not in out
+
+
+def test_one_invalid_byte_does_not_change_the_decoding(tmp_path):
+    p = tmp_path / "blandet.md"
+    p.write_bytes("Sesongkort på Føyka ".encode("utf-8") + b"\xff" + " æøå".encode("utf-8"))
+    assert ingest._read_kb_file(p) == "Sesongkort på Føyka \ufffd æøå"
+
+
+def test_tfidf_fit_is_reused_for_unchanged_texts(monkeypatch, tmp_path):
+    monkeypatch.setattr(ingest, "DATA_DIR", tmp_path)
+    chunks = [{"text": t} for t in ["Sesongkort på Føyka", "Parkering på kampdag"]]
+    first = ingest._build_tfidf_sparse(chunks)
+    fit = ingest._fit_tfidf
+    monkeypatch.setattr(ingest, "_fit_tfidf", lambda texts: 1 / 0)
+    assert abs(ingest._build_tfidf_sparse(chunks) - first).max() == 0
+    monkeypatch.setattr(ingest, "_fit_tfidf", fit)
+    changed = ingest._build_tfidf_sparse(chunks[:1])
+    assert changed.shape[0] == 1
+    assert len(list((tmp_path / "cache").iterdir())) == 2
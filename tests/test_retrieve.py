@@ -1,11 +1,194 @@
+import importlib.util
 import os
 import numpy as np
+from scipy import sparse
 
 
 def test_artifacts_exist():
     """Sjekk at indeksartefakter finnes etter bygging og har forventet format."""
     assert os.path.exists("data/meta.jsonl"), "meta.jsonl mangler – kjør build_index"
-    assert os.path.exists("data/vectors.npy"), "vectors.npy mangler – kjør build_index"
-    assert os.path.exists("data/index.faiss"), "index.faiss mangler – kjør build_index"
-    X = np.load("data/vectors.npy")
-    assert X.ndim == 2 and X.shape[0] > 0, "Vektorfilen må ha minst én rad"
\ No newline at end of file
+    if os.path.exists("data/vectors.npz"):
+        # TF-IDF lagres som sparse CSR-matrise
+        X = sparse.load_npz("data/vectors.npz")
+    else:
+        assert os.path.exists("data/vectors.npy"), "vectors.npy/npz mangler – kjør build_index"
+        if importlib.util.find_spec("faiss") is not None:
+            assert os.path.exists("data/index.faiss"), "index.faiss mangler – kjør build_index"
+        X = np.load("data/vectors.npy")
+    assert X.ndim == 2 and X.shape[0] > 0, "Vektorfilen må ha minst én rad"
+
+
+def test_tfidf_index_is_reused_from_disk_cache(monkeypatch, tmp_path):
+    import src.retrieve as retrieve
+
+    kb = tmp_path / "kb"
+    kb.mkdir()
+    (kb / "billetter.md").write_text("# Billetter\nSesongkort koster 1500 kroner.", encoding="utf-8")
+    (kb / "parkering.md").write_text("# Parkering\nParker ved Føyka på kampdag.", encoding="utf-8")
+    monkeypatch.setattr(retrieve, "KB_DIRS", [kb])
+    monkeypatch.setattr(retrieve, "TFIDF_CACHE_DIR", tmp_path / "tfidf_cache")
+    monkeypatch.setattr(retrieve, "_TF", None)
+    monkeypatch.setattr(retrieve, "_MTX", None)
+    monkeypatch.setattr(retrieve, "_MTX_T", None)
+    monkeypatch.setattr(retrieve, "_META", [])
+    first = retrieve.search_tfidf("sesongkort", 1)
+
+    monkeypatch.setattr(retrieve, "_TF", None)
+    monkeypatch.setattr(retrieve, "_MTX", None)
+    monkeypatch.setattr(retrieve, "_MTX_T", None)
+    monkeypatch.setattr(retrieve, "_process_one_file", lambda p: 1 / 0)
+    assert retrieve.search_tfidf("sesongkort", 1) == first
+    retrieve.clear_query_cache()
+
+
+def test_query_embeddings_are_cached_on_disk(monkeypatch, tmp_path):
+    from types import SimpleNamespace
+
+    import src.retrieve as retrieve
+
+    sent = []
+
+    def create(model, input):
+        batch = [input] if isinstance(input, str) else list(input)
+        sent.extend(batch)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(t)), 1.0]) for t in batch])
+
+    monkeypatch.setattr(retrieve, "_openai", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(retrieve, "_use_openai", lambda: True)
+    monkeypatch.setattr(retrieve, "DATA_DIR", tmp_path)
+    monkeypatch.setattr(retrieve, "_QEMB_DB", None)
+
+    assert retrieve.warmup(["sesongkort", "parkering", "sesongkort"]) == 2
+    assert sent == ["sesongkort", "parkering"]
+    # Ny prosess: cachen leses fra disk
+    monkeypatch.setattr(retrieve, "_QEMB_DB", None)
+    v = retrieve._embed_query("sesongkort")
+    assert sent == ["sesongkort", "parkering"]
+    assert np.allclose(v, np.array([10.0, 1.0]) / np.hypot(10.0, 1.0))
+
+
+def test_int8_index_is_written_by_ingest_and_loaded_by_retrieve(monkeypatch, tmp_path):
+    import pytest
+
+    pytest.importorskip("faiss")
+    import src.ingest as ingest
+    import src.retrieve as retrieve
+    from src.utils import index_signature
+
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((50, 16)).astype(np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    rows = [{"id": f"d.md#{i}", "hash": f"h{i}", "text": f"t{i}"} for i in range(len(X))]
+    np.save(tmp_path / "vectors.npy", X)
+    with (tmp_path / "meta.jsonl").open("w", encoding="utf-8") as f:
+        for r in rows:
+            f.write(f'{{"id": "{r["id"]}", "hash": "{r["hash"]}", "text": "{r["text"]}"}}\n')
+    monkeypatch.setattr(ingest, "EMB_QUANT", "int8")
+    assert ingest._maybe_write_faiss(X, tmp_path / "index.faiss")
+    (tmp_path / "index.sig").write_text(index_signature(rows), encoding="utf-8")
+    monkeypatch.setattr(retrieve, "DATA_DIR", tmp_path)
+    for name, value in (("_EMB", None), ("_META_OAI", []), ("_FAISS", None)):
+        monkeypatch.setattr(retrieve, name, value)
+    monkeypatch.setattr(retrieve, "_embed_query", lambda q: X[7])
+    hits = retrieve._search_openai("x", 3)
+    assert retrieve._FAISS is not None and retrieve._FAISS.ntotal == 50
+    assert retrieve._FAISS.sa_code_size() == 16  # én byte per dimensjon
+    assert hits[0]["id"] == "d.md#7"
+
+
+def test_faiss_index_is_ignored_when_signature_does_not_match_meta(monkeypatch, tmp_path):
+    import pytest
+
+    faiss = pytest.importorskip("faiss")
+    import src.retrieve as retrieve
+    from src.utils import index_signature
+
+    rows = [{"id": f"d.md#{i}", "hash": f"h{i}"} for i in range(4)]
+    index = faiss.IndexFlatIP(4)
+    index.add(np.eye(4, dtype=np.float32))
+    faiss.write_index(index, str(tmp_path / "index.faiss"))
+    monkeypatch.setattr(retrieve, "DATA_DIR", tmp_path)
+    assert retrieve._load_faiss(4, index_signature(rows)) is None
+    (tmp_path / "index.sig").write_text(index_signature(rows), encoding="utf-8")
+    assert retrieve._load_faiss(4, index_signature(rows)).ntotal == 4
+    # Samme antall rader, men nytt innhold: indeksen er utdatert
+    rows[2]["hash"] = "endret"
+    assert retrieve._load_faiss(4, index_signature(rows)) is None
+
+
+def test_duplicate_chunks_share_one_tfidf_row(monkeypatch, tmp_path):
+    import src.retrieve as retrieve
+
+    kb = tmp_path / "kb"
+    kb.mkdir()
+    for name in ("billetter.md", "billetter-kopi.md", "parkering.md"):
+        body = "Parker ved Føyka." if name == "parkering.md" else "Sesongkort koster 1500 kroner."
+        (kb / name).write_text(body, encoding="utf-8")
+    monkeypatch.setattr(retrieve, "KB_DIRS", [kb])
+    monkeypatch.setattr(retrieve, "TFIDF_CACHE_DIR", tmp_path / "tfidf_cache")
+    monkeypatch.setattr(retrieve, "_TF", None)
+    monkeypatch.setattr(retrieve, "_MTX", None)
+    monkeypatch.setattr(retrieve, "_MTX_T", None)
+    monkeypatch.setattr(retrieve, "_META", [])
+    _, mtx, meta = retrieve._ensure_index_tfidf()
+    assert mtx.shape[0] == len(meta) == 2
+    hit = retrieve.search_tfidf("sesongkort", 1)[0]
+    assert hit["id"].endswith("billetter-kopi.md#0")
+    assert hit["aliases"][0].endswith("billetter.md#0")
+    retrieve.search("sesongkort", 1)[0]["aliases"].append("endret")
+    assert retrieve.search("sesongkort", 1)[0]["aliases"] == hit["aliases"]
+    retrieve.clear_query_cache()
+
+
+def test_search_many_embeds_all_queries_in_one_call(monkeypatch, tmp_path):
+    from types import SimpleNamespace
+
+    import src.retrieve as retrieve
+
+    X = np.eye(4, dtype=np.float32)
+    np.save(tmp_path / "vectors.npy", X)
+    with (tmp_path / "meta.jsonl").open("w", encoding="utf-8") as f:
+        for i in range(len(X)):
+            f.write(f'{{"id": "d.md#{i}", "text": "t{i}"}}\n')
+    calls = []
+
+    def create(model, input):
+        calls.append(list(input))
+        return SimpleNamespace(data=[SimpleNamespace(embedding=list(X[int(q)] + 0.1)) for q in input])
+
+    monkeypatch.setattr(retrieve, "_openai", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(retrieve, "_use_openai", lambda: True)
+    monkeypatch.setattr(retrieve, "DATA_DIR", tmp_path)
+    for name, value in (("_QEMB_DB", None), ("_EMB", None), ("_META_OAI", []), ("_FAISS", None)):
+        monkeypatch.setattr(retrieve, name, value)
+    hits = retrieve.search_many(["2", "0", "2"], k=2)
+    assert calls == [["2", "0"]]
+    assert [h[0]["id"] for h in hits] == ["d.md#2", "d.md#0", "d.md#2"]
+
+
+def test_tfidf_rebuild_only_reads_changed_files(monkeypatch, tmp_path):
+    import src.retrieve as retrieve
+
+    kb = tmp_path / "kb"
+    kb.mkdir()
+    (kb / "billetter.md").write_text("# Billetter\nSesongkort koster 1500 kroner.", encoding="utf-8")
+    (kb / "parkering.md").write_text("# Parkering\nParker ved Føyka på kampdag.", encoding="utf-8")
+    monkeypatch.setattr(retrieve, "KB_DIRS", [kb])
+    monkeypatch.setattr(retrieve, "TFIDF_CACHE_DIR", tmp_path / "tfidf_cache")
+
+    def rebuild():
+        for name in ("_TF", "_MTX", "_MTX_T"):
+            monkeypatch.setattr(retrieve, name, None)
+        retrieve.clear_query_cache()
+        return retrieve.search_tfidf("sesongkort parkering", 3)
+
+    rebuild()
+    read = []
+    process = retrieve._process_one_file
+    monkeypatch.setattr(retrieve, "_process_one_file", lambda p: read.append(p.name) or process(p))
+    (kb / "parkering.md").write_text("# Parkering\nParkering ved Føyka, sesongkort gir rabatt.", encoding="utf-8")
+    incremental = rebuild()
+    assert read == ["parkering.md"]
+
+    monkeypatch.setattr(retrieve, "TFIDF_CACHE_DIR", tmp_path / "fresh_cache")
+    assert rebuild() == incremental